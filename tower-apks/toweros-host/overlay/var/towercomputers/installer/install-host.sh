@@ -197,10 +197,33 @@ EOF
 	chmod 600 /etc/ssh/ssh_host_*
 }
 
+check_boot_media_space() {
+	# the boot partition is sized for its content: the new kernel files
+	# replace the old ones in place and must fit in the free space left
+	needed=$(du -sk /mnt/boot/*rpi* | awk '{sum += $1} END {print sum}')
+	replaced=0
+	for file in /mnt/boot/*rpi*; do
+		if [ -e "$BOOT_MEDIA/boot/$(basename $file)" ]; then
+			replaced=$((replaced + $(du -sk "$BOOT_MEDIA/boot/$(basename $file)" | awk '{print $1}')))
+		fi
+	done
+	available=$(df -k $BOOT_MEDIA | tail -1 | awk '{print $4}')
+	if [ "$needed" -gt $((available + replaced)) ]; then
+		echo "Not enough space in the boot partition for the kernel: ${needed}K needed, $((available + replaced))K available. Rebuild the image with a bigger \`--boot-headroom\`."
+		exit 1
+	fi
+}
+
 clone_live_system_to_disk() {
     # install base system
     ovlfiles=/tmp/ovlfiles
-    lbu package - | tar -C "/mnt" -zxv > $ovlfiles
+    if [ -f "$BOOT_MEDIA/rootfs.tar.zst" ]; then
+        # prebuilt by buildhost.py from the same packages: only the live system overlay on top
+        zstd -dcq "$BOOT_MEDIA/rootfs.tar.zst" | tar -C "/mnt" -xpf -
+        lbu package - | tar -C "/mnt" -zxf -
+    else
+        lbu package - | tar -C "/mnt" -zxv > $ovlfiles
+    fi
     # comment out local repositories
     if [ -f /mnt/etc/apk/repositories ]; then
         sed -i -e 's:^/:#/:' /mnt/etc/apk/repositories
@@ -226,11 +249,25 @@ clone_live_system_to_disk() {
 
 	mkdir -p /mnt/boot
 
-    # install packages
-    local apkflags="--initdb --quiet --progress --update-cache --clean-protected"
-    local pkgs="$(grep -h -v -w sfdisk /mnt/etc/apk/world 2>/dev/null)"
-    local repoflags="--repository $BOOT_MEDIA/apks"
-    apk add --root /mnt $apkflags --overlay-from-stdin --force-overwrite $repoflags $pkgs <$ovlfiles
+    # install packages, already done in the prebuilt root filesystem
+    if ! [ -f "$BOOT_MEDIA/rootfs.tar.zst" ]; then
+        local apkflags="--initdb --quiet --progress --update-cache --clean-protected"
+        local pkgs="$(grep -h -v -w sfdisk /mnt/etc/apk/world 2>/dev/null)"
+        local repoflags="--repository $BOOT_MEDIA/apks"
+        apk add --root /mnt $apkflags --overlay-from-stdin --force-overwrite $repoflags $pkgs <$ovlfiles
+    else
+        # the prebuilt initramfs has no LUKS key: generate it again now that /mnt/crypto_keyfile.bin exists
+        chroot /mnt mkinitfs "$(ls /mnt/lib/modules | head -1)"
+    fi
+
+    # packages of the host downloaded by `tower upgrade --bake-packages` in the preserved home
+    baked_repo="/mnt/home/$USERNAME/.tower-apks"
+    if [ "$BAKED_PACKAGES" == "true" ] && [ -f "$baked_repo/world" ]; then
+        cp $BOOT_MEDIA/tower-apks.rsa.pub /mnt/etc/apk/keys/
+        apk add --root /mnt --quiet --no-network --repository $BOOT_MEDIA/apks --repository "$baked_repo" $(cat "$baked_repo/world")
+        rm /mnt/etc/apk/keys/tower-apks.rsa.pub
+    fi
+    rm -rf "$baked_repo"
 
     # clean chroot
     umount /mnt/proc
@@ -238,6 +275,7 @@ clone_live_system_to_disk() {
 
 	# prepare boot and root partitions and folders
 	mount -o remount,rw $BOOT_MEDIA
+	check_boot_media_space
 	cp -rf /mnt/boot/*rpi* $BOOT_MEDIA/boot/
 	rm -Rf /mnt/boot
 
@@ -276,6 +314,8 @@ clean_and_reboot() {
 	rm $BOOT_MEDIA/tower.env
 	# remove sshd host keys
 	rm $BOOT_MEDIA/ssh_host_*
+	# remove the key of the baked packages
+	rm -f $BOOT_MEDIA/tower-apks.rsa.pub
 	# remove keyfile
 	rm /mnt/crypto_keyfile.bin
 	# reboot
@@ -287,6 +327,7 @@ init_configuration() {
 	# HOSTNAME, USERNAME, PUBLIC_KEY, PASSWORD_HASH, KEYBOARD_LAYOUT, KEYBOARD_VARIANT, 
 	# TIMEZONE, LANG, ONLINE, WLAN_SSID, WLAN_SHARED_KEY, THIN_CLIENT_IP, TOWER_NETWORK, 
 	# STATIC_HOST_IP, ROUTER_IP, INSTALLATION_TYPE, COLOR, ALPINE_BRANCH
+	# and MAY contain BAKED_PACKAGES
 
 	if [ -f /media/usb/tower.env ]; then # boot on usb
 		source /media/usb/tower.env
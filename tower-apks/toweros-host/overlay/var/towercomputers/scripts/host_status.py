@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+
+import glob
+import json
+import sys
+
+MODEL_PATHS = [
+    "/sys/firmware/devicetree/base/model",
+    "/proc/device-tree/model",
+    "/sys/class/dmi/id/product_name",
+]
+
+def read_file(path):
+    try:
+        with open(path, 'r', encoding="UTF-8", errors="ignore") as file_pointer:
+            return file_pointer.read().strip("\x00\n ")
+    except OSError:
+        return None
+
+def get_system():
+    for path in MODEL_PATHS:
+        model = read_file(path)
+        if model:
+            return model
+    return None
+
+def get_memory():
+    meminfo = {}
+    for line in read_file("/proc/meminfo").split("\n"):
+        key, value = line.split(":", 1)
+        meminfo[key] = int(value.split()[0]) * 1024
+    available = meminfo.get("MemAvailable", meminfo["MemFree"])
+    return meminfo["MemTotal"], meminfo["MemTotal"] - available
+
+def get_cpu_usage():
+    # same as `mpstat` without interval: average since boot
+    # user, nice, system, idle, iowait, irq, softirq, steal
+    times = [int(value) for value in read_file("/proc/stat").split("\n")[0].split()[1:9]]
+    return round(100 - times[3] * 100 / sum(times), 2)
+
+def get_cpu_temperature():
+    zones = sorted(glob.glob("/sys/class/thermal/thermal_zone*"))
+    # prefer the zone dedicated to the cpu, if any
+    zones.sort(key=lambda zone: "cpu" not in (read_file(f"{zone}/type") or ""))
+    for zone in zones:
+        temperature = read_file(f"{zone}/temp")
+        if temperature:
+            return round(int(temperature) / 1000, 1)
+    return None
+
+def get_status():
+    memory_total, memory_used = get_memory()
+    return {
+        "system": get_system(),
+        "memory-total": memory_total,
+        "memory-used": memory_used,
+        "cpu-usage": get_cpu_usage(),
+        "cpu-temperature": get_cpu_temperature(),
+    }
+
+if __name__ == '__main__':
+    json.dump(get_status(), sys.stdout, separators=(",", ":"))
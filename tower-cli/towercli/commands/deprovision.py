@@ -1,5 +1,3 @@
-from towerlib import provision, sshconf
-
 def add_args(argparser):
     help_message = "Deprovision a host."
     parser = argparser.add_parser(
@@ -21,8 +19,10 @@ def add_args(argparser):
     )
 
 def check_args(args, parser_error):
+    from towerlib import sshconf
     if not sshconf.exists(args.name[0]):
         parser_error("Host not found in TowerOS configuration file.")
 
 def execute(args):
+    from towerlib import provision
     provision.deprovision(args.name[0], no_confirm=args.no_confirm)
@@ -1,8 +1,5 @@
 import re
 
-from towerlib import sshconf
-from towerlib import install
-
 def add_args(argparser):
     help_message = "Install an application on a host with APK"
     install_parser = argparser.add_parser(
@@ -21,6 +18,7 @@ def add_args(argparser):
     )
 
 def check_args(args, parser_error):
+    from towerlib import sshconf
     name = args.host[0]
     config = sshconf.get(name)
 
@@ -32,4 +30,5 @@ def check_args(args, parser_error):
             parser_error(f"Invalid package name:{pkg_name}")
 
 def execute(args):
+    from towerlib import install
     install.install_packages(args.host[0], args.packages)
@@ -1,5 +1,3 @@
-from towerlib import utils
-
 def add_args(argparser):
     argparser.add_parser('mdhelp')
 
@@ -9,4 +7,5 @@ def check_args(args, parser_error):
 
 # pylint: disable=unused-argument
 def execute(parser):
+    from towerlib import utils
     print(utils.gen_md_help(parser))
@@ -1,5 +1,3 @@
-from towerlib import sshconf
-
 from towercli.commands import status as status_command
 
 def add_args(argparser):
@@ -21,4 +19,5 @@ def check_args(args, parser_error):
 
 
 def execute(args):
+    from towerlib import sshconf
     sshconf.poweroff(args.host)
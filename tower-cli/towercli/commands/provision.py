@@ -3,7 +3,7 @@ import os
 import re
 import sys
 
-from towerlib import provision, utils, sshconf, config
+from towerlib import config
 
 logger = logging.getLogger('tower')
 
@@ -42,6 +42,20 @@ def add_args(argparser, upgrade=False):
             help="""Path to virtual device for the SD card or USB key.""",
             required=False,
         )
+        parser.add_argument(
+            '--parallel',
+            help="""Maximum number of hosts upgraded at the same time. (Default: 4)""",
+            type=int,
+            required=False,
+            default=4
+        )
+        parser.add_argument(
+            '--bake-packages',
+            help="""Download the packages installed in each host before the upgrade and install them with the system, instead of re-installing them afterwards over the network. (Default: False)""",
+            required=False,
+            action='store_true',
+            default=False
+        )
     parser.add_argument(
         '--boot-device',
         help="""Path to virtual device for the SD card or USB key.""",
@@ -160,18 +174,18 @@ def add_args(argparser, upgrade=False):
             required=False,
             default=""
         )
-        next_color_name = sshconf.get_next_color_name()
         parser.add_argument(
             '--color',
-            help=f"Color used for shell prompt and GUI. (Default: sequentially from the list, next: {next_color_name})",
+            help="Color used for shell prompt and GUI. (Default: sequentially from the list)",
             type=str,
             required=False,
-            choices=sshconf.color_name_list(),
-            default=next_color_name
+            choices=[color[1] for color in config.COLORS],
+            default=None
         )
 
 
 def check_common_args(args, parser_error):
+    from towerlib import utils
     if args.boot_device:
         disk_list = utils.get_device_list()
         if args.boot_device not in disk_list:
@@ -182,8 +196,8 @@ def check_common_args(args, parser_error):
         if not os.path.exists(args.image):
             parser_error(message="Invalid path to the image.")
         ext = args.image.split(".").pop()
-        if os.path.exists(args.image) and ext not in ['img', 'xz']:
-            parser_error(message="Invalid extension for image path. Must be either `xz`or `img`.")
+        if os.path.exists(args.image) and ext not in ['img', 'xz', 'zst']:
+            parser_error(message="Invalid extension for image path. Must be `img`, `xz` or `zst`.")
     if args.ifname:
         interaces = utils.get_interfaces()
         if args.ifname not in interaces:
@@ -220,6 +234,7 @@ def check_keys_args(args, parser_error):
 
 
 def check_provision_args(args, parser_error):
+    from towerlib import sshconf
     if re.match(r'/^(?![0-9]{1,15}$)[a-z0-9-]{1,15}$/', args.name[0]):
         parser_error(message="Host name is invalid. Must be between 1 and 15 lowercase alphanumeric characters.")
     if sshconf.exists(args.name[0]) and not args.force:
@@ -247,6 +262,7 @@ def check_args(args, parser_error):
 
 
 def execute(args):
+    from towerlib import provision
     try:
         provision.provision(args.name[0], args)
     except provision.MissingEnvironmentValue as exc:
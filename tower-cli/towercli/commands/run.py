@@ -1,8 +1,6 @@
 import os
 import logging
 
-from towerlib import sshconf
-from towerlib import vnc
 from towerlib.utils.exceptions import TowerException
 
 logger = logging.getLogger('tower')
@@ -46,13 +44,15 @@ def add_args(argparser):
 
 
 def check_args(args, parser_error):
-    config = sshconf.get(args.host[0])
-    if config is None:
+    from towerlib import sshconf
+    if sshconf.get(args.host[0]) is None:
         parser_error("Unknown host.")
 
 
 def execute(args):
     if os.getenv('DISPLAY'):
+        # imports gi, Gtk and GtkVnc
+        from towerlib import vnc
         vnc.run(args.host[0], ' '.join(args.run_command), args)
     else:
         raise TowerException("`tower run` requires a running desktop environment. Use `startw` to start Labwc.")
@@ -1,6 +1,6 @@
 import json
 
-from towerlib import sshconf
+from towerlib import config
 
 def add_args(argparser):
     help_message = "Check the status of all hosts in the Tower system."
@@ -16,7 +16,21 @@ def add_args(argparser):
     )
     status_parser.add_argument(
         '--json',
-        help="""Json output. (Default: False)""",
+        help="""Json output. Without `--host`, one JSON object is printed per line as soon as each host answers. (Default: False)""",
+        required=False,
+        action='store_true',
+        default=False
+    )
+    status_parser.add_argument(
+        '--timeout',
+        help=f"""Maximum time to wait for all hosts to answer, in seconds. Specify `0` for no limit. (Default: {config.STATUS_TIMEOUT})""",
+        type=int,
+        required=False,
+        default=config.STATUS_TIMEOUT
+    )
+    status_parser.add_argument(
+        '--refresh',
+        help="""Probe the hosts now instead of using the latest status sampled by the `tower-status` service. (Default: False)""",
         required=False,
         action='store_true',
         default=False
@@ -25,12 +39,20 @@ def add_args(argparser):
 def check_args(args, parser_error):
     if not args.host:
         return
-    config = sshconf.get(args.host)
-    if config is None:
+    from towerlib import sshconf
+    if sshconf.get(args.host) is None:
         parser_error("Unknown host.")
 
 def execute(args):
-    if args.json:
-        print(json.dumps(sshconf.status(args.host), indent=4))
+    from towerlib import sshconf
+    snapshot = None if args.refresh or not args.json else sshconf.load_status_snapshot()
+    if args.json and args.host:
+        host_status = snapshot[args.host] if snapshot else sshconf.status(args.host)
+        print(json.dumps(host_status, indent=4))
+    elif args.json:
+        hosts_status = (sshconf.summary_status(snapshot[host]) for host in sshconf.hosts()) if snapshot \
+            else sshconf.iter_status(timeout=args.timeout)
+        for host_status in hosts_status:
+            print(json.dumps(host_status), flush=True)
     else:
-        sshconf.display_status(args.host)
+        sshconf.display_status(args.host, args.timeout, args.refresh)
@@ -1,5 +1,3 @@
-from towerlib import sshconf
-
 def add_args(argparser):
     argparser.add_parser('synctime')
 
@@ -8,4 +6,5 @@ def check_args(args, parser_error):
     pass
 
 def execute(args):
+    from towerlib import sshconf
     sshconf.sync_time()
@@ -3,20 +3,22 @@ import sys
 
 from towercli.commands import provision as provision_command
 
-from towerlib import provision, sshconf
-
 logger = logging.getLogger('tower')
 
 def add_args(argparser):
     provision_command.add_args(argparser, upgrade=True)
 
 def check_args(args, parser_error):
+    from towerlib import sshconf
     for name in args.hosts or []:
         if not sshconf.exists(name):
             parser_error(f"Host `{name}` not found in TowerOS configuration file.")
+    if args.parallel < 1:
+        parser_error("`--parallel` must be greater than 0.")
     provision_command.check_common_args(args, parser_error)
 
 def execute(args):
+    from towerlib import provision, sshconf
     try:
         if args.hosts is None:
             provision.upgrade_thinclient(args)
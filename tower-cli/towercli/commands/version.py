@@ -1,7 +1,5 @@
 import json
 
-from towerlib import sshconf
-
 def add_args(argparser):
     help_message = "Get the version of TowerOS installed on the thin client and hosts."
     argparser.add_parser(
@@ -15,4 +13,5 @@ def check_args(args, parser_error):
 
 # pylint: disable=unused-argument
 def execute(args):
+    from towerlib import sshconf
     print(json.dumps(sshconf.get_version(), indent=4))
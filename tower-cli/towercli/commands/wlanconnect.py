@@ -1,6 +1,6 @@
 import logging
 
-from towerlib import provision, sshconf, config
+from towerlib import config
 
 logger = logging.getLogger('tower')
 
@@ -24,8 +24,10 @@ def add_args(argparser):
 
 # pylint: disable=unused-argument
 def check_args(args, parser_error):
+    from towerlib import sshconf
     if not sshconf.exists(config.ROUTER_HOSTNAME):
         parser_error(message=f"`{config.ROUTER_HOSTNAME}` host not found. Please provision it first.")
 
 def execute(args):
+    from towerlib import provision
     provision.wlan_connect(args.ssid, args.password)
@@ -2,6 +2,7 @@ import argparse
 import sys
 
 from towerlib import utils
+from towerlib.utils import trace
 from towerlib.utils.exceptions import TowerException
 
 import towercli
@@ -39,6 +40,11 @@ def towercli_parser():
         action='store_true',
         default=False
     )
+    parser.add_argument(
+        '--trace',
+        help="""Write the timeline of the command steps in this file, in Chrome trace format (open it with https://ui.perfetto.dev).""",
+        required=False,
+    )
     subparser = parser.add_subparsers(
         dest='command',
         required=True,
@@ -56,7 +62,8 @@ def towercli_parser():
     deprovision.add_args(subparser)
     mdhelp.add_args(subparser) # hidden command
     synctime.add_args(subparser) # hidden command
-    utils.mdhelp.insert_autocompletion_command(parser) # hidden command
+    if '--print-completion' in sys.argv:
+        utils.mdhelp.insert_autocompletion_command(parser) # hidden command, shtab is slow to import
     return parser
 
 
@@ -76,6 +83,8 @@ def main():
     try:
         args = parse_arguments()
         utils.clilogger.initialize(args.verbose, args.quiet)
+        if args.trace:
+            trace.start_trace(args.trace)
         if args.command == 'mdhelp':
             mdhelp.execute(towercli_parser())
         else:
@@ -83,3 +92,6 @@ def main():
     except TowerException as exc:
         utils.clilogger.print_error(str(exc))
         sys.exit()
+    finally:
+        # also written when the command fails, to see where
+        trace.write_trace()
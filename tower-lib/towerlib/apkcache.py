@@ -0,0 +1,125 @@
+import os
+import json
+import logging
+import shutil
+import tarfile
+
+from towerlib.utils.shell import apk
+from towerlib.utils import network
+from towerlib.config import APK_CACHE_DIR
+from towerlib.utils.exceptions import BuildException
+
+logger = logging.getLogger('tower')
+
+ALPINE_MIRROR = "http://dl-cdn.alpinelinux.org/alpine"
+
+
+def repositories(branch):
+    return [f"{ALPINE_MIRROR}/{branch}/main", f"{ALPINE_MIRROR}/{branch}/community"]
+
+
+def parse_apkindex(content):
+    # one paragraph per package: `P:` name, `V:` version, `C:` checksum of the package
+    packages = {}
+    for paragraph in content.strip().split("\n\n"):
+        fields = dict(line.split(":", 1) for line in paragraph.split("\n") if ":" in line)
+        if 'P' in fields and 'V' in fields:
+            packages[f"{fields['P']}-{fields['V']}.apk"] = {
+                'name': fields['P'],
+                'version': fields['V'],
+                'checksum': fields.get('C', ''),
+            }
+    return packages
+
+
+def read_apkindex(index_path):
+    with tarfile.open(index_path, 'r:gz') as archive:
+        return parse_apkindex(archive.extractfile('APKINDEX').read().decode())
+
+
+def fetch_indexes(branch, arch):
+    # a few MB, downloaded at each build to know the current checksums
+    packages = {}
+    for repository in repositories(branch):
+        index_path = os.path.join(APK_CACHE_DIR, 'indexes', branch, os.path.basename(repository), arch, 'APKINDEX.tar.gz')
+        network.download_file(f"{repository}/{arch}/APKINDEX.tar.gz", index_path)
+        packages.update(read_apkindex(index_path))
+    return packages
+
+
+def resolve_packages(branch, arch, root, packages):
+    # package files needed by `packages` and their dependencies, nothing is downloaded
+    repository_args = []
+    for repository in repositories(branch):
+        repository_args += ['--repository', repository]
+    urls = apk(
+        'fetch', '--simulate', '--url', '-R', '--no-cache', '--allow-untrusted',
+        '--arch', arch, '--root', root, *repository_args, *packages
+    )
+    return [os.path.basename(line.strip()) for line in urls.strip().split("\n") if line.strip().endswith('.apk')]
+
+
+def cache_dir(arch):
+    return os.path.join(APK_CACHE_DIR, arch)
+
+
+def load_manifest(arch):
+    try:
+        with open(os.path.join(cache_dir(arch), 'manifest.json'), 'r', encoding="UTF-8") as file_pointer:
+            return json.load(file_pointer)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def save_manifest(arch, manifest):
+    manifest_path = os.path.join(cache_dir(arch), 'manifest.json')
+    with open(f"{manifest_path}.tmp", 'w', encoding="UTF-8") as file_pointer:
+        json.dump(manifest, file_pointer, indent=4, sort_keys=True)
+    os.replace(f"{manifest_path}.tmp", manifest_path)
+
+
+def is_cached(arch, manifest, file_name, checksum):
+    # same name, same version and same checksum in APKINDEX: the file did not change
+    return manifest.get(file_name) == checksum and os.path.exists(os.path.join(cache_dir(arch), file_name))
+
+
+def fetch_packages(branch, arch, root, packages):
+    os.makedirs(cache_dir(arch), exist_ok=True)
+    index = fetch_indexes(branch, arch)
+    manifest = load_manifest(arch)
+    file_names = resolve_packages(branch, arch, root, packages)
+    unknown = [file_name for file_name in file_names if file_name not in index]
+    if unknown:
+        raise BuildException(f"Packages not found in APKINDEX: {', '.join(unknown)}")
+    missing = [file_name for file_name in file_names if not is_cached(arch, manifest, file_name, index.get(file_name, {}).get('checksum'))]
+    logger.info("%s packages in cache, %s to download", len(file_names) - len(missing), len(missing))
+    if missing:
+        repository_args = []
+        for repository in repositories(branch):
+            repository_args += ['--repository', repository]
+        # exact versions, dependencies are already resolved
+        versions = [f"{index[file_name]['name']}={index[file_name]['version']}" for file_name in missing]
+        apk(
+            'fetch', '--no-cache', '--allow-untrusted', '--arch', arch, '--root', root,
+            *repository_args, '-o', cache_dir(arch), *versions, _out=logger.debug
+        )
+        for file_name in missing:
+            manifest[file_name] = index[file_name]['checksum']
+        save_manifest(arch, manifest)
+    return [os.path.join(cache_dir(arch), file_name) for file_name in file_names]
+
+
+def link_packages(package_paths, repo_path):
+    dest_paths = []
+    for package_path in package_paths:
+        dest_path = os.path.join(repo_path, os.path.basename(package_path))
+        try:
+            os.link(package_path, dest_path)
+        except OSError: # cache and repo in different file systems
+            shutil.copyfile(package_path, dest_path)
+        dest_paths.append(dest_path)
+    return dest_paths
+
+
+def index_cache_path(arch):
+    return os.path.join(cache_dir(arch), 'APKINDEX.unsigned.tar.gz')
@@ -1,33 +1,37 @@
 import os
+import fcntl
 import time
 from datetime import datetime
 import logging
 import glob
 import getpass
+import hashlib
 import tempfile
-from io import StringIO
+import tarfile
+from io import StringIO, BytesIO
 
 from towerlib.utils.shell import (
     Command, ErrorReturnCode,
     mount, parted, mkdosfs, tee, cat, echo,
-    cp, rm, sync, rsync, chown, truncate, mkdir,
-    tar, xz, apk, dd,
-    losetup, abuild_sign, openssl,
-    scp, ssh, runuser,
+    cp, rm, sync, chown, truncate, mkdir,
+    tar, xz, zstd, apk,
+    abuild, abuild_sign, openssl,
+    scp, ssh,
 )
 
-from towerlib import utils, config, sshconf
-from towerlib.utils import clitask
+from towerlib import utils, config, sshconf, apkcache
+from towerlib.utils import clitask, blockio
+from towerlib.utils.stages import Stage, run_stages
 from towerlib.__about__ import __version__
-from towerlib.config import TOWER_DIR, HOST_ALPINE_BRANCH, APK_LOCAL_REPOSITORY
+from towerlib.hostregistry import registry
+from towerlib.config import HOST_ALPINE_BRANCH, APK_LOCAL_REPOSITORY
 from towerlib.utils.exceptions import LockException, BuildException
 
-mkfs_ext4 = Command('mkfs.ext4')
-fsck_ext4 = Command('fsck.ext4')
-
 logger = logging.getLogger('tower')
 
 WORKING_DIR = os.path.join(os.path.expanduser('~'), 'build-toweros-host-work')
+# separated from the build working dir: burning never touches the state kept for `--resume`
+BURN_WORKING_DIR = os.path.join(os.path.expanduser('~'), 'burn-toweros-host-work')
 NOPYFILES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'nopyfiles')
 REPO_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..')
 TMP_DIR = tempfile.gettempdir()
@@ -35,6 +39,9 @@ TMP_DIR = tempfile.gettempdir()
 BUILDER_HOST = "builder"
 USERNAME = getpass.getuser()
 ARCH = "aarch64"
+BOOT_PART_START = 4 * 1024 * 1024 # bytes, also the partitions alignment
+FAT_CLUSTER_SIZE = 4 * 512 # `mkdosfs -s 4`
+FAT32_MIN_PART_SIZE = 132 * 1024 * 1024 # at least 65525 clusters, aligned
 
 def sprint(value):
     print(value, end='', flush=True)
@@ -44,22 +51,30 @@ def wdir(path):
     return os.path.join(WORKING_DIR, path)
 
 
-def prepare_working_dir():
-    if os.path.exists(WORKING_DIR):
-        raise LockException(f"f{WORKING_DIR} already exists! Is another build in progress? If not, delete this folder and try again.")
-    os.makedirs(WORKING_DIR)
+def bdir(path):
+    return os.path.join(BURN_WORKING_DIR, path)
 
 
-def fetch_apk_packages(repo_path, branch, packages):
-    apk(
-        'fetch', '--arch', ARCH, '-R', '--url', '--no-cache', '--allow-untrusted',
-        '--root', wdir("EXPORT_BOOTFS_DIR"),
-        '--repository', f'http://dl-cdn.alpinelinux.org/alpine/{branch}/main',
-        '--repository', f'http://dl-cdn.alpinelinux.org/alpine/{branch}/community',
-        '-o', repo_path, *packages, _out=logger.debug
-    )
+def prepare_working_dir(lock_file, resume=False):
+    # the lock is released when the build ends, even killed: a failed build never blocks the next one
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError as exc:
+        raise LockException(f"{WORKING_DIR} is locked by another build. Wait for it to finish and try again.") from exc
+    if not resume:
+        # state of the previous build, only reused with `--resume`
+        for entry in os.listdir(WORKING_DIR):
+            if entry != "lock":
+                rm('-rf', wdir(entry), _out=logger.debug)
+
+
+def prepare_burn_working_dir():
+    if os.path.exists(BURN_WORKING_DIR):
+        raise LockException(f"f{BURN_WORKING_DIR} already exists! Is another installation in progress? If not, delete this folder and try again.")
+    os.makedirs(BURN_WORKING_DIR)
 
 
+@clitask("Downloading APK packages...")
 def download_apk_packages(repo_path):
     world_path = os.path.join(REPO_PATH, 'tower-apks', 'toweros-host', 'world')
     apks = []
@@ -68,74 +83,85 @@ def download_apk_packages(repo_path):
         if package.startswith('linux-firmware-brcm-cm4'):
             continue
         apks.append(line.strip())
-    # download packages
-    fetch_apk_packages(repo_path, HOST_ALPINE_BRANCH, apks)
+    # download new or changed packages in the cache, then link them in the repository
+    package_paths = apkcache.fetch_packages(HOST_ALPINE_BRANCH, ARCH, wdir("EXPORT_BOOTFS_DIR"), apks)
+    # paths in the repository: checked by `--resume` with the other stage outputs
+    return apkcache.link_packages(package_paths, repo_path)
 
 
+@clitask("Building linux-firmware-brcm-cm4 APK...")
 def build_brcrm_cm4_apk(repo_path):
     # build and copy linux-firmware-brcm-cm4
-    Command('sh')(
-        '-c',
-        f'runuser -u {USERNAME} -- abuild -r',
-        _cwd=f"{REPO_PATH}/tower-apks/linux-firmware-brcm-cm4"
-    )
+    abuild('-r', _cwd=f"{REPO_PATH}/tower-apks/linux-firmware-brcm-cm4")
     cp(f"{APK_LOCAL_REPOSITORY}/x86_64/linux-firmware-brcm-cm4-1.0-r0.apk", repo_path)
+    return os.path.join(repo_path, "linux-firmware-brcm-cm4-1.0-r0.apk")
 
 
+@clitask("Building toweros-host APK on the builder...")
 def build_toweros_host_apk(repo_path):
+    # unprivileged stage: ssh and scp run as the user, with their keys
     out = {"_out": logger.debug, "_err_to_out": True}
-    with runuser.bake('-u', USERNAME, '--'):
-        ssh(BUILDER_HOST, 'sudo apk add alpine-sdk', **out)
-        ssh(BUILDER_HOST, f'sudo addgroup {USERNAME} abuild', **out)
-        ssh(BUILDER_HOST, 'rm -rf .abuild tower-apks tower-lib', **out)
-        scp('-r', f'{REPO_PATH}/tower-apks', f'{BUILDER_HOST}:', **out)
-        scp('-r', f'{REPO_PATH}/tower-lib', f'{BUILDER_HOST}:', **out)
-        scp('-r', f'/home/{USERNAME}/.abuild', f'{BUILDER_HOST}:', **out)
-        ssh(BUILDER_HOST, 'sudo cp .abuild/*.pub /etc/apk/keys/', **out)
-        ssh(BUILDER_HOST, 'cd tower-apks/toweros-host && abuild -r', **out)
-        scp(f'{BUILDER_HOST}:packages/tower-apks/{ARCH}/toweros-host-{__version__}-r0.apk', TMP_DIR, **out)
+    ssh(BUILDER_HOST, 'sudo apk add alpine-sdk', **out)
+    ssh(BUILDER_HOST, f'sudo addgroup {USERNAME} abuild', **out)
+    ssh(BUILDER_HOST, 'rm -rf .abuild tower-apks tower-lib', **out)
+    scp('-r', f'{REPO_PATH}/tower-apks', f'{BUILDER_HOST}:', **out)
+    scp('-r', f'{REPO_PATH}/tower-lib', f'{BUILDER_HOST}:', **out)
+    scp('-r', f'/home/{USERNAME}/.abuild', f'{BUILDER_HOST}:', **out)
+    ssh(BUILDER_HOST, 'sudo cp .abuild/*.pub /etc/apk/keys/', **out)
+    ssh(BUILDER_HOST, 'cd tower-apks/toweros-host && abuild -r', **out)
+    scp(f'{BUILDER_HOST}:packages/tower-apks/{ARCH}/toweros-host-{__version__}-r0.apk', TMP_DIR, **out)
     cp(f'{TMP_DIR}/toweros-host-{__version__}-r0.apk', repo_path)
+    return os.path.join(repo_path, f"toweros-host-{__version__}-r0.apk")
 
 
-def prepare_apk_repos(private_key_path):
-    repo_path = wdir(f"EXPORT_BOOTFS_DIR/apks/{ARCH}/")
-    rm('-rf', repo_path)
-    mkdir('-p',repo_path)
-    # download packages
-    build_toweros_host_apk(repo_path)
-    download_apk_packages(repo_path)
-    build_brcrm_cm4_apk(repo_path)
-    # prepare index
-    apks = glob.glob(wdir(f"EXPORT_BOOTFS_DIR/apks/{ARCH}/*.apk"))
-    apk_index_path = wdir(f"EXPORT_BOOTFS_DIR/apks/{ARCH}/APKINDEX.tar.gz")
+@clitask("Indexing APK repository...")
+def index_apk_repo(repo_path, private_key_path, *_packages):
+    # called when all the packages are in the repository
+    apks = glob.glob(os.path.join(repo_path, "*.apk"))
+    apk_index_path = os.path.join(repo_path, "APKINDEX.tar.gz")
     apk_index_opts = ['index', '--arch', ARCH, '--rewrite-arch', ARCH, '--allow-untrusted']
+    if os.path.exists(apkcache.index_cache_path(ARCH)):
+        # entries of the previous build are reused for the unchanged packages
+        apk_index_opts += ['--index', apkcache.index_cache_path(ARCH)]
     apk(*apk_index_opts, '-o', apk_index_path, *apks, _out=logger.debug)
+    cp(apk_index_path, apkcache.index_cache_path(ARCH))
     # sign index
     abuild_sign('-k', private_key_path, apk_index_path, _out=logger.debug)
+    return apk_index_path
 
 
-@clitask("Preparing Alpine Linux system...")
-def prepare_system_image(alpine_tar_path, private_key_path):
-    # prepare disk image
-    mkfs_ext4(
-        '-O', '^has_journal,^resize_inode',
-        '-E', 'lazy_itable_init=0,root_owner=0:0',
-        '-m', '0',
-        '-U', 'clear',
-        '--', wdir("root.img"), '4G',
-        _out=logger.debug
+@clitask("Building TowerOS-Host root filesystem on the builder...")
+def build_rootfs(public_key_path, _apk_index):
+    # the packages of the boot media repository, installed once here instead of on each host
+    # the repository stays in the image: the live system installs `toweros-host`, and so all of it, at boot
+    out = {"_out": logger.debug, "_err_to_out": True}
+    ssh(BUILDER_HOST, 'rm -rf rootfs-apks rootfs.tar.zst', **out)
+    scp('-r', wdir("EXPORT_BOOTFS_DIR/apks"), f'{BUILDER_HOST}:rootfs-apks', **out)
+    scp(os.path.join(NOPYFILES_DIR, 'mkrootfs-toweros-host.sh'), public_key_path, f'{BUILDER_HOST}:', **out)
+    ssh(
+        BUILDER_HOST,
+        f'sudo sh mkrootfs-toweros-host.sh rootfs-apks {os.path.basename(public_key_path)} rootfs.tar.zst toweros-host',
+        **out
     )
-    # mount image in temporary folder
+    scp(f'{BUILDER_HOST}:rootfs.tar.zst', TMP_DIR, **out)
+    cp(f'{TMP_DIR}/rootfs.tar.zst', wdir("EXPORT_BOOTFS_DIR/rootfs.tar.zst"))
+    return wdir("EXPORT_BOOTFS_DIR/rootfs.tar.zst")
+
+
+@clitask("Preparing Alpine Linux system...")
+def prepare_system_image(alpine_tar_path):
+    # plain staging folder, copied as is in the FAT partition
+    rm('-rf', wdir("EXPORT_BOOTFS_DIR"))
     mkdir('-p', wdir("EXPORT_BOOTFS_DIR"))
-    mount(wdir("root.img"), wdir("EXPORT_BOOTFS_DIR"))
     # put alpine linux files
     tar('-xpf', alpine_tar_path, '-C', wdir("EXPORT_BOOTFS_DIR"))
-    prepare_apk_repos(private_key_path)
-    # synchronize folder
-    sync(wdir("EXPORT_BOOTFS_DIR"))
+    repo_path = wdir(f"EXPORT_BOOTFS_DIR/apks/{ARCH}/")
+    mkdir('-p', repo_path)
+    return repo_path
 
 
-def prepare_overlay(pub_key_path):
+@clitask("Preparing overlay...")
+def prepare_overlay(pub_key_path, _repo_path):
     # put public key used to signe apk index
     mkdir('-p', wdir("overlay/etc/apk/keys/"))
     cp(pub_key_path, wdir(f"overlay/etc/apk/keys/{os.path.basename(pub_key_path)}"))
@@ -144,75 +170,117 @@ def prepare_overlay(pub_key_path):
         os.path.join(NOPYFILES_DIR, 'genapkovl-toweros-host.sh'),
         wdir("overlay"),
         _cwd=wdir("EXPORT_BOOTFS_DIR/"),
-        _out=print
+        _out=logger.debug
     )
     tee(wdir("EXPORT_BOOTFS_DIR/usercfg.txt"), _in=echo("dtoverlay=dwc2,dr_mode=host"))
+    return wdir("EXPORT_BOOTFS_DIR/usercfg.txt")
+
+
+def align_size(size, alignment):
+    return -(-size // alignment) * alignment
+
+
+def staged_size(path):
+    # space used in the FAT partition: files rounded up to the cluster size,
+    # directories with 64 bytes per entry (short and long names)
+    size = 0
+    for root, dirs, files in os.walk(path):
+        size += align_size((len(dirs) + len(files) + 2) * 64, FAT_CLUSTER_SIZE)
+        size += sum(align_size(os.lstat(os.path.join(root, file)).st_size, FAT_CLUSTER_SIZE) for file in files)
+    return size
+
+
+def fat_capacity(part_size):
+    # minus the 32 reserved sectors and the two 32 bits FAT tables
+    return part_size - 32 * 512 - 2 * 4 * (part_size // FAT_CLUSTER_SIZE)
+
+
+def boot_partition_size(system_size, headroom):
+    size = align_size(max(system_size + headroom, FAT32_MIN_PART_SIZE), BOOT_PART_START)
+    while fat_capacity(size) < system_size + headroom:
+        size += BOOT_PART_START
+    return size
 
 
 @clitask("Creating RPI partitions...")
-def create_rpi_boot_partition():
+def create_rpi_boot_partition(boot_headroom, *_system_parts):
     image_file = wdir("toweros-host.img")
-    # caluclate sizes
-    boot_size = 512 * 1024 * 1024
-    # All partition sizes and starts will be aligned to this size
-    align = 4 * 1024 * 1024
-    # Add this much space to the calculated file size. This allows for
-    # some overhead (since actual space usage is usually rounded up to the
-    # filesystem block size) and gives some free space on the resulting
-    # image.
-    boot_part_start = align
-    boot_part_size = int((boot_size + align - 1) / align) * align
+    # sized from the staged system, plus some free space for the installer and the configuration
+    system_size = staged_size(wdir("EXPORT_BOOTFS_DIR"))
+    boot_part_size = boot_partition_size(system_size, boot_headroom)
+    logger.info("Staged system: %s MiB for a %s MiB boot partition", system_size // 1024 // 1024, boot_part_size // 1024 // 1024)
+    boot_part_start = BOOT_PART_START
     boot_part_end = boot_part_start + boot_part_size - 1
     image_size = boot_part_start + boot_part_size
-    # create image file
+    # create image file, without the data of a previous build
+    rm('-f', image_file)
     truncate('-s', image_size, image_file)
     # make partitions
     parted('--script', image_file, 'mklabel', 'msdos', _out=logger.debug)
     parted('--script', image_file, 'unit', 'B', 'mkpart', 'primary', 'fat32', boot_part_start, boot_part_end, _out=logger.debug)
+    return image_file
 
 
-def create_loop_device(image_file):
-    loop_dev = losetup('--show', '--find', '--partscan', image_file).strip()
-    retry = 1
-    while not loop_dev and retry < 5:
-        time.sleep(5)
-        retry +=1
-        loop_dev = losetup('--show', '--find', '--partscan', image_file).strip()
-    if loop_dev:
-        return loop_dev
-    raise BuildException("losetup failed; exiting")
+@clitask("Copying Alpine Linux system in RPI partitions...")
+def prepare_rpi_partitions(image_file, *_system_parts):
+    system_dir = wdir("EXPORT_BOOTFS_DIR")
+    boot_part_size = os.path.getsize(image_file) - BOOT_PART_START
+    # FAT32 written in the image file at the partition offset: no loop device, no mount
+    mkdosfs(
+        '-n', 'bootfs', '-F', 32, '-s', 4, '-v',
+        '--offset', BOOT_PART_START // 512, image_file, boot_part_size // 1024,
+        _out=logger.debug
+    )
+    # copy system in partition, all the files in one mtools call
+    entries = [os.path.join(system_dir, entry) for entry in sorted(os.listdir(system_dir))]
+    Command('mcopy')(
+        '-i', f"{image_file}@@{BOOT_PART_START}", '-s', '-p', '-m', '-Q', *entries, '::/',
+        _env={**os.environ, 'MTOOLS_SKIP_CHECK': '1'}, _out=logger.debug
+    )
+    return image_file
 
 
-@clitask("Copying Alpine Linux system in RPI partitions...")
-def prepare_rpi_partitions(loop_dev):
-    boot_dev = f"{loop_dev}p1"
-    # format partitions
-    mkdosfs('-n', 'bootfs', '-F', 32, '-s', 4, '-v', boot_dev, _out=logger.debug)
-    # mount partitions
-    mkdir('-p', wdir("BOOTFS_DIR"), _out=logger.debug)
-    mount('-v', boot_dev, wdir("BOOTFS_DIR"), '-t', 'vfat')
-    # copy system in partitions
-    rsync('-rtxv', wdir("EXPORT_BOOTFS_DIR/"), wdir("BOOTFS_DIR/"), _out=logger.debug)
-
-
-@clitask("Compressing image with xz...")
-def compress_image(build_dir):
-    image_name = datetime.now().strftime(f'toweros-host-{__version__}-%Y%m%d%H%M%S.img.xz')
+@clitask("Compressing image with {2}...")
+def compress_image(build_dir, _raw_image, compression='xz'):
+    image_name = datetime.now().strftime(f'toweros-host-{__version__}-%Y%m%d%H%M%S.img.{compression}')
     tmp_image_path = os.path.join(tempfile.gettempdir(), image_name)
     image_path = os.path.join(build_dir or config.TOWER_BUILDS_DIR, image_name)
-    xz(
-        '--compress', '--force',
-        '--threads', 0, '--memlimit-compress=90%', '--best',
-	    '--stdout', wdir("toweros-host.img"),
-        _out=tmp_image_path
-    )
+    if compression == 'zst':
+        # much faster to decompress in the hosts than xz, for a slightly bigger image
+        zstd('-19', '-T0', '-q', '-f', '-c', wdir("toweros-host.img"), _out=tmp_image_path)
+    else:
+        xz(
+            '--compress', '--force',
+            '--threads', 0, '--memlimit-compress=90%', '--best',
+            '--stdout', wdir("toweros-host.img"),
+            _out=tmp_image_path
+        )
     cp(tmp_image_path, image_path)
     chown(f"{USERNAME}:{USERNAME}", image_path)
     return image_path
 
 
+def bmap_path(image_path):
+    # same name as the uncompressed image, like bmaptool: toweros-host-<version>-<date>.img.bmap
+    return f"{image_path.removesuffix('.xz').removesuffix('.zst')}.bmap"
+
+
+@clitask("Generating block map...")
+def generate_bmap(raw_image):
+    # from the raw image, while it is compressed
+    tmp_bmap_path = wdir("toweros-host.img.bmap")
+    blockio.write_bmap(raw_image, tmp_bmap_path)
+    return tmp_bmap_path
+
+
+def install_bmap(tmp_bmap_path, image_path):
+    cp(tmp_bmap_path, bmap_path(image_path))
+    chown(f"{USERNAME}:{USERNAME}", bmap_path(image_path))
+    return bmap_path(image_path)
+
+
 @clitask("Copying image...")
-def copy_image(build_dir):
+def copy_image(build_dir, _raw_image):
     image_path = os.path.join(build_dir or config.TOWER_BUILDS_DIR, datetime.now().strftime(f'toweros-host-{__version__}-%Y%m%d%H%M%S.img'))
     cp(wdir("toweros-host.img"), image_path)
     chown(f"{USERNAME}:{USERNAME}", image_path)
@@ -220,16 +288,13 @@ def copy_image(build_dir):
 
 
 def unmount_all():
-    utils.lazy_umount(wdir("BOOTFS_DIR"))
-    utils.lazy_umount(wdir("EXPORT_BOOTFS_DIR"))
+    utils.lazy_umount(bdir("BOOTFS_DIR"))
 
 
 @clitask("Cleaning up...")
-def cleanup(loopdev = None):
+def cleanup_burn():
     unmount_all()
-    rm('-rf', WORKING_DIR, _out=logger.debug)
-    if loopdev:
-        losetup('-d', loopdev)
+    rm('-rf', BURN_WORKING_DIR, _out=logger.debug)
 
 
 def prepare_apk_key():
@@ -241,43 +306,132 @@ def prepare_apk_key():
     return private_key_path, public_key_path
 
 
+def build_stages(uncompressed, build_dir, compression='xz', boot_headroom=config.HOST_BOOT_HEADROOM):
+    # each stage starts as soon as the stages producing its inputs are done, as the user unless `sudo` is set
+    # `sources` and `params`: what, beside the inputs, makes a stage run again with `--resume`
+    apks_path = os.path.join(REPO_PATH, 'tower-apks')
+    return [
+        Stage(
+            'alpine', utils.download_alpine_rpi,
+            outputs=['alpine_tar_path'], params=[config.ALPINE_RPI_URL, config.ALPINE_RPI_CHECKSUM]
+        ),
+        Stage('apk-key', prepare_apk_key, outputs=['private_key_path', 'public_key_path']),
+        Stage(
+            'system', prepare_system_image,
+            inputs=['alpine_tar_path'], outputs=['repo_path']
+        ),
+        Stage(
+            'toweros-host-apk', build_toweros_host_apk,
+            inputs=['repo_path'], outputs=['toweros_host_apk'],
+            sources=[os.path.join(apks_path, 'toweros-host'), os.path.join(REPO_PATH, 'tower-lib', 'towerlib')],
+            params=[__version__]
+        ),
+        Stage(
+            'apk-packages', download_apk_packages,
+            inputs=['repo_path'], outputs=['apk_packages'],
+            sources=[os.path.join(apks_path, 'toweros-host', 'world')], params=[HOST_ALPINE_BRANCH],
+            # `apk --root` on the staged system
+            sudo=True
+        ),
+        Stage(
+            'brcm-cm4-apk', build_brcrm_cm4_apk,
+            inputs=['repo_path'], outputs=['brcm_cm4_apk'],
+            sources=[os.path.join(apks_path, 'linux-firmware-brcm-cm4')]
+        ),
+        Stage(
+            'apk-index', index_apk_repo,
+            inputs=['repo_path', 'private_key_path', 'toweros_host_apk', 'apk_packages', 'brcm_cm4_apk'],
+            outputs=['apk_index']
+        ),
+        Stage(
+            'overlay', prepare_overlay,
+            inputs=['public_key_path', 'repo_path'], outputs=['overlay'],
+            sources=[os.path.join(NOPYFILES_DIR, 'genapkovl-toweros-host.sh')],
+            # the files of the overlay archive must belong to root in the host
+            sudo=True
+        ),
+        Stage(
+            'rootfs', build_rootfs,
+            inputs=['public_key_path', 'apk_index'], outputs=['rootfs_archive'],
+            sources=[os.path.join(NOPYFILES_DIR, 'mkrootfs-toweros-host.sh')]
+        ),
+        Stage(
+            'partitions',
+            lambda apk_index, overlay, rootfs_archive: create_rpi_boot_partition(boot_headroom, apk_index, overlay, rootfs_archive),
+            inputs=['apk_index', 'overlay', 'rootfs_archive'], outputs=['image_file'], params=[boot_headroom]
+        ),
+        Stage('copy-system', prepare_rpi_partitions, inputs=['image_file', 'apk_index', 'overlay'], outputs=['raw_image']),
+        Stage(
+            'image',
+            lambda raw_image: copy_image(build_dir, raw_image) if uncompressed else compress_image(build_dir, raw_image, compression),
+            inputs=['raw_image'], outputs=['image_path'], params=[uncompressed, build_dir, compression]
+        ),
+        Stage('bmap', generate_bmap, inputs=['raw_image'], outputs=['tmp_bmap_path']),
+        Stage('install-bmap', install_bmap, inputs=['tmp_bmap_path', 'image_path'], outputs=['bmap_path']),
+    ]
+
+
+# `sudo` only for this thread, to clear the files of the privileged stages: each stage sets its own
 @clitask("Building TowerOS-Host image...", timer_message="TowserOS-Host image built in {0}.", sudo=True, task_parent=True)
-def build_image(uncompressed=False, build_dir=None):
-    alpine_tar_path = utils.download_alpine_rpi()
-    loop_dev = None
-    image_path = None
-    try:
-        prepare_working_dir()
-        private_key_path, public_key_path = prepare_apk_key()
-        prepare_system_image(alpine_tar_path, private_key_path)
-        prepare_overlay(public_key_path)
-        create_rpi_boot_partition()
-        loop_dev = create_loop_device(wdir("toweros-host.img"))
-        prepare_rpi_partitions(loop_dev)
-        unmount_all()
-        if uncompressed:
-            image_path = copy_image(build_dir)
-        else:
-            image_path = compress_image(build_dir)
-    finally:
-        cleanup(loop_dev)
+def build_image(uncompressed=False, build_dir=None, resume=False, compression='xz', boot_headroom=config.HOST_BOOT_HEADROOM):
+    artifacts = {}
+    os.makedirs(WORKING_DIR, exist_ok=True)
+    with open(wdir("lock"), 'w', encoding="UTF-8") as lock_file:
+        prepare_working_dir(lock_file, resume)
+        # stages manifests are kept in the working dir with the files they produced, after a failure or a success
+        run_stages(build_stages(uncompressed, build_dir, compression, boot_headroom), artifacts, checkpoint_dir=wdir("stages"), resume=resume)
+    image_path = artifacts.get('image_path')
     if image_path:
         logger.info("Image ready: %s", image_path)
     return image_path
 
 
+class BlockIOOutput:
+    # stderr of blockio.py: progress lines update the task spinner, the rest is kept for errors
+    # created in the task: `sh` calls it from its own thread, where the task spinner is unknown
+    def __init__(self):
+        self.buf = StringIO()
+        self.progress = utils.progress_reporter()
+
+    def __call__(self, line):
+        if line.startswith("progress: "):
+            self.progress(line.removeprefix("progress: ").strip())
+        else:
+            self.buf.write(line)
+
+    def getvalue(self):
+        return self.buf.getvalue()
+
+
+def blockio_args(image_file, device, verify=False, bmap_file=None):
+    args = ['write', image_file, device]
+    if bmap_file:
+        # only the blocks in use, checked against the block map
+        args += ['--bmap', bmap_file]
+    if verify:
+        args.append('--verify')
+    return args
+
+
 @clitask("Copying {0} in {1}...")
-def copy_image_in_device(image_file, device):
+def write_image_in_device(image_file, device, verify=False):
     utils.unmount_all(device)
-    # burn image
+    # burn image, xz and zstd images are decompressed on the fly: no temporary copy
+    output = BlockIOOutput()
+    bmap_file = bmap_path(image_file) if os.path.exists(bmap_path(image_file)) else None
     try:
-        buf = StringIO()
-        dd(f'if={image_file}', f'of={device}', 'bs=8M', _out=buf)
+        return Command('python3')(blockio.__file__, *blockio_args(image_file, device, verify, bmap_file), _err=output).strip()
     except ErrorReturnCode as exc:
         error_message = "Error copying image. Please check the boot device integrity and try again with the flag `--zero-device`."
-        logger.error(buf.getvalue())
+        logger.error(output.getvalue())
         logger.error(error_message)
         raise BuildException(error_message) from exc
+
+
+def copy_image_in_device(image_file, device, verify=False):
+    report = write_image_in_device(image_file, device, verify)
+    if report:
+        logger.info(report)
     # determine partition name
     boot_part = Command('sh')('-c', f'ls {device}*1').strip()
     if not boot_part:
@@ -287,63 +441,107 @@ def copy_image_in_device(image_file, device):
 
 @clitask("Zeroing {0} please be patient...")
 def zeroing_device(device):
-    dd('if=/dev/zero', f'of={device}', 'bs=8M', _out=logger.debug)
+    logger.debug(Command('python3')(blockio.__file__, 'zero', device, _err=BlockIOOutput()).strip())
+
+
+def add_payload_file(archive, name, content, mode):
+    info = tarfile.TarInfo(name)
+    info.size = len(content)
+    info.mode = mode
+    info.mtime = int(time.time())
+    archive.addfile(info, BytesIO(content))
+
+
+def boot_payload(host_config):
+    # tower.env, luks key and host ssh keys in a tar archive, extracted in the boot partition
+    record = registry.get(host_config['HOSTNAME'])
+    str_env = "\n".join([f"{key}='{value}'" for key, value in host_config.items()])
+    buffer = BytesIO()
+    with tarfile.open(fileobj=buffer, mode='w') as archive:
+        add_payload_file(archive, 'tower.env', f"{str_env}\n".encode(), 0o644)
+        with open(record.paths.luks_key, 'rb') as file_pointer:
+            add_payload_file(archive, 'crypto_keyfile.bin', file_pointer.read(), 0o600)
+        for host_keys_path in record.paths.ssh_host_keys:
+            with open(host_keys_path, 'rb') as file_pointer:
+                add_payload_file(archive, os.path.basename(host_keys_path), file_pointer.read(), 0o600)
+            with open(f"{host_keys_path}.pub", 'rb') as file_pointer:
+                add_payload_file(archive, f"{os.path.basename(host_keys_path)}.pub", file_pointer.read(), 0o644)
+        if host_config.get('BAKED_PACKAGES') == 'true':
+            # trusted by the installer for the packages copied in the host home
+            with open(f"{record.paths.apk_key}.pub", 'rb') as file_pointer:
+                add_payload_file(archive, os.path.basename(f"{record.paths.apk_key}.pub"), file_pointer.read(), 0o644)
+    return buffer.getvalue()
 
 
 @clitask("Configuring image...")
 def insert_tower_env(boot_part, host_config):
-    # mount boot partition
-    mkdir('-p', wdir("BOOTFS_DIR/"))
-    mount(boot_part, wdir("BOOTFS_DIR/"), '-t', 'vfat')
-    str_env = "\n".join([f"{key}='{value}'" for key, value in host_config.items()])
-    # insert tower.env file in boot partition
-    tee(wdir("BOOTFS_DIR/tower.env"), _in=echo(str_env))
-    # insert luks key in boot partition
-    keys_path = os.path.join(TOWER_DIR, 'hosts', host_config['HOSTNAME'], "crypto_keyfile.bin")
-    cp(keys_path, wdir("BOOTFS_DIR/crypto_keyfile.bin"))
-    # insert host ssh keys in boot partition
-    for key_type in ['ecdsa', 'rsa', 'ed25519']:
-        host_keys_path = os.path.join(TOWER_DIR, 'hosts', host_config['HOSTNAME'], f"ssh_host_{key_type}_key")
-        cp(host_keys_path, wdir(f"BOOTFS_DIR/ssh_host_{key_type}_key"))
-        cp(f"{host_keys_path}.pub", wdir(f"BOOTFS_DIR/ssh_host_{key_type}_key.pub"))
+    payload = boot_payload(host_config)
+    # mount boot partition, `quiet`: vfat ignores the permissions instead of failing
+    mkdir('-p', bdir("BOOTFS_DIR/"))
+    mount(boot_part, bdir("BOOTFS_DIR/"), '-t', 'vfat', '-o', 'quiet')
+    # insert tower.env, luks key and host ssh keys in boot partition
+    tar('-x', '-o', '-f', '-', '-C', bdir("BOOTFS_DIR/"), _in=payload)
+    sync()
 
 
 @clitask("Installing TowserOS-Host on {1}...", timer_message="TowserOS-Host installed in {0}.", sudo=True, task_parent=True)
 def burn_image(image_file, device, new_config, zero_device=False):
+    # outside the `try`: the working dir of another installation is not removed
+    prepare_burn_working_dir()
     try:
         # make sure the password is not stored in th sd-card
         host_config = {**new_config}
         if 'PASSWORD' in host_config:
             del host_config['PASSWORD']
-        prepare_working_dir()
         if zero_device:
             zeroing_device(device)
         boot_part = copy_image_in_device(image_file, device)
         insert_tower_env(boot_part, host_config)
     finally:
-        cleanup()
+        cleanup_burn()
 
 
-@clitask("Transferring image {0} to host {1}...")
-def copy_image_to_host(image_file, host):
-    scp(image_file, f'{host}:')
+@clitask("Transferring block writer to host {1}...")
+def copy_blockio_to_host(image_file, host):
+    files = [blockio.__file__]
+    if os.path.exists(bmap_path(image_file)):
+        files.append(bmap_path(image_file))
+    scp(*files, f'{host}:')
 
 
-@clitask("Zeroing {0} please be patient...")
+@clitask("Zeroing {1} please be patient...")
 def zero_device_in_host(host, device):
-    ssh(host, f'sudo dd if=/dev/zero of={device} bs=8M')
+    ssh(host, f'sudo python3 {os.path.basename(blockio.__file__)} zero {device}', _err=BlockIOOutput())
+
+
+def read_image_chunks(image_file, hasher):
+    with open(image_file, 'rb') as file_pointer:
+        while chunk := file_pointer.read(blockio.BUFFER_SIZE):
+            hasher.update(chunk)
+            yield chunk
 
 
 @clitask("Burning image {1} in {2}...")
 def copy_image_in_host_device(host, image_file, device):
+    # the image is streamed, still compressed, in the ssh channel and written as it arrives: no copy in the host
+    output = BlockIOOutput()
+    bmap_file = os.path.basename(bmap_path(image_file)) if os.path.exists(bmap_path(image_file)) else None
+    args = blockio_args('-', device, bmap_file=bmap_file) + ['--sha256']
+    if image_file.endswith('.xz'):
+        args.append('--xz')
+    elif image_file.endswith('.zst'):
+        args.append('--zstd')
+    hasher = hashlib.sha256()
     try:
-        buf = StringIO()
-        ssh(host, f'sudo dd if={os.path.basename(image_file)} of={device} bs=8M', _out=buf, _err_to_out=True)
+        report = ssh(host, f'sudo python3 {os.path.basename(blockio.__file__)} {" ".join(args)}', _in=read_image_chunks(image_file, hasher), _err=output)
     except ErrorReturnCode as exc:
         error_message = "Error copying image. Please check the boot device integrity and try again with the flag `--zero-device`."
-        logger.error(buf.getvalue())
+        logger.error(output.getvalue())
         logger.error(error_message)
         raise BuildException(error_message) from exc
+    logger.debug(report.strip())
+    if f"sha256: {hasher.hexdigest()}" not in report:
+        raise BuildException("Image corrupted during the transfer to the host. Please try again.")
     # determine partition name
     boot_part = ssh(host, f"sh -c 'ls {device}*1'").strip()
     if not boot_part:
@@ -353,52 +551,38 @@ def copy_image_in_host_device(host, image_file, device):
 
 @clitask("Configuring image...")
 def insert_tower_env_in_host(host, boot_part, host_config):
-    debug_args = {"_out": logger.debug, "_err_to_out": True}
-    # mount boot partition
-    ssh(host, 'sudo mkdir -p /boot', **debug_args)
-    ssh(host, f'sudo mount {boot_part} /boot -t vfat',**debug_args)
-    str_env = "\n".join([f"{key}='{value}'" for key, value in host_config.items()])
-    # insert tower.env file in boot partition
-    tee(wdir("tower.env"), _in=echo(str_env))
-    scp(wdir("tower.env"), f'{host}:', **debug_args)
-    ssh(host, 'sudo cp tower.env /boot/tower.env', **debug_args)
-    # insert luks key in boot partition
-    keys_path = os.path.join(TOWER_DIR, 'hosts', host, "crypto_keyfile.bin")
-    scp(keys_path, f'{host}:', **debug_args)
-    ssh(host, 'sudo cp crypto_keyfile.bin /boot/crypto_keyfile.bin', **debug_args)
-    # insert host ssh keys in boot partition
-    for key_type in ['ecdsa', 'rsa', 'ed25519']:
-        host_keys_path = os.path.join(TOWER_DIR, 'hosts', host_config['HOSTNAME'], f"ssh_host_{key_type}_key")
-        scp(host_keys_path, f'{host}:', **debug_args)
-        ssh(host, f'sudo cp ssh_host_{key_type}_key /boot/ssh_host_{key_type}_key', **debug_args)
-        scp(f"{host_keys_path}.pub", f'{host}:', **debug_args)
-        ssh(host, f'sudo cp ssh_host_{key_type}_key.pub /boot/ssh_host_{key_type}_key.pub', **debug_args)
-    ssh(host, 'sudo umount /boot', **debug_args)
-    ssh(host, 'sudo rm -rf /boot', **debug_args)
+    # one ssh exec: mount boot partition, extract tower.env, luks key and host ssh keys, then unmount
+    script = " && ".join([
+        "mkdir -p /boot",
+        f"mount {boot_part} /boot -t vfat -o quiet",
+        "tar -x -o -f - -C /boot",
+        "sync",
+        "umount /boot",
+        "rm -rf /boot",
+    ])
+    ssh(host, f"sudo sh -c '{script}'", _in=boot_payload(host_config), _out=logger.debug, _err_to_out=True)
 
 
 @clitask("Rebooting host {0}...")
 def reboot_host(host):
     ssh(host, "sudo reboot")
+    sshconf.close_connection(host)
     while sshconf.is_up(host):
         time.sleep(1)
 
 
 @clitask("Installing TowserOS-Host on host {0}...", timer_message="TowserOS-Host installed in {0}.", task_parent=True)
 def burn_image_in_host(host, image_file, device, new_config, zero_device=False):
-    try:
-        # make sure the password is not stored in th sd-card
-        host_config = {**new_config}
-        if 'PASSWORD' in host_config:
-            del host_config['PASSWORD']
-        prepare_working_dir()
-        # move image to host and copy it in device
-        ssh(host, 'sudo umount /boot', _ok_code=[0, 1])
-        if zero_device:
-            zero_device_in_host(host, device)
-        copy_image_to_host(image_file, host)
-        boot_part = copy_image_in_host_device(host, image_file, device)
-        insert_tower_env_in_host(host, boot_part, host_config)
-        reboot_host(host)
-    finally:
-        cleanup()
+    # nothing is written in the local working dir: several hosts can be upgraded at the same time
+    # make sure the password is not stored in th sd-card
+    host_config = {**new_config}
+    if 'PASSWORD' in host_config:
+        del host_config['PASSWORD']
+    # move image to host and copy it in device
+    ssh(host, 'sudo umount /boot', _ok_code=[0, 1])
+    copy_blockio_to_host(image_file, host)
+    if zero_device:
+        zero_device_in_host(host, device)
+    boot_part = copy_image_in_host_device(host, image_file, device)
+    insert_tower_env_in_host(host, boot_part, host_config)
+    reboot_host(host)
@@ -15,8 +15,18 @@ TOWER_BUILDS_DIR = "/var/towercomputers/builds"
 TOWER_SSH_CONFIG_PATH = os.path.join(TOWER_DIR, 'config')
 SSH_CONFIG_PATH = os.path.expanduser('~/.ssh/config')
 KNOWN_HOSTS_PATH = os.path.expanduser('~/.ssh/known_hosts')
+SSH_CONTROL_DIR = os.path.join(TOWER_DIR, 'ssh')
+SSH_CONTROL_PERSIST = 60 # seconds
+SSH_PROBE_TIMEOUT = 2 # seconds
+SSH_PROBE_INTERVAL = 1 # seconds
+STATUS_TIMEOUT = 10 # seconds
+STATUS_INTERVAL = 10 # seconds
+STATUS_SNAPSHOT_PATH = os.path.join(TOWER_DIR, 'status.json')
+STATUS_SNAPSHOT_MAX_AGE = 30 # seconds
 DESKTOP_FILES_DIR = os.path.expanduser('~/.local/share/applications')
 APK_LOCAL_REPOSITORY = os.path.expanduser('~/packages/tower-apks')
+APK_CACHE_DIR = os.path.expanduser('~/.cache/tower/apks')
+HOST_BOOT_HEADROOM = 64 * 1024 * 1024 # bytes, free space in the host boot partition
 RELEASES_URL = "https://raw.githubusercontent.com/towercomputers/toweros/dev/RELEASES"
 COLORS = [
     [39, "White", "ffffff"],
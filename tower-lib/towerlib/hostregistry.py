@@ -0,0 +1,129 @@
+import os
+import threading
+from collections import namedtuple
+
+from towerlib.config import TOWER_DIR, COLORS
+
+SSH_HOST_KEY_TYPES = ['ecdsa', 'rsa', 'ed25519']
+
+
+def parse_tower_env(config_str):
+    host_config = {}
+    for line in config_str.strip().split("\n"):
+        if '=' not in line:
+            continue
+        key, value = line.split('=', 1)
+        # values are single-quoted: KEY='value'
+        host_config[key] = value[1:-1]
+    return host_config
+
+
+def file_signature(path):
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+
+# files of the host in ~/.local/tower/hosts/<host>/
+HostPaths = namedtuple('HostPaths', ['private_key', 'luks_key', 'ssh_host_keys', 'apk_key'])
+
+
+def host_paths(host_dir):
+    return HostPaths(
+        private_key=os.path.join(host_dir, 'id_ed25519'),
+        luks_key=os.path.join(host_dir, 'crypto_keyfile.bin'),
+        ssh_host_keys=tuple(os.path.join(host_dir, f"ssh_host_{key_type}_key") for key_type in SSH_HOST_KEY_TYPES),
+        # signs the index of the packages baked by `tower upgrade --bake-packages`
+        apk_key=os.path.join(host_dir, 'tower-apks.rsa'),
+    )
+
+
+class HostRecord:
+    __slots__ = ('name', 'signature', 'config', 'packages', 'paths')
+
+    def __init__(self, name, host_dir, signature, config, packages):
+        self.name = name
+        self.signature = signature
+        self.config = config
+        self.packages = packages
+        self.paths = host_paths(host_dir)
+
+    @property
+    def color_code(self):
+        return int((self.config or {}).get('COLOR', COLORS[0][0]))
+
+    @property
+    def online(self):
+        return (self.config or {}).get('ONLINE') == 'true'
+
+    @property
+    def ip(self):
+        return (self.config or {}).get('STATIC_HOST_IP')
+
+    @property
+    def version(self):
+        return (self.config or {}).get('TOWEROS_VERSION', 'N/A')
+
+
+class HostRegistry:
+    def __init__(self, hosts_dir=os.path.join(TOWER_DIR, 'hosts')):
+        self.hosts_dir = hosts_dir
+        self.records = {}
+        self.lock = threading.Lock()
+
+    def paths(self, host):
+        host_dir = os.path.join(self.hosts_dir, host)
+        return host_dir, os.path.join(host_dir, 'tower.env'), os.path.join(host_dir, 'world')
+
+    def load(self, host, signature):
+        host_dir, config_path, world_path = self.paths(host)
+        config = None
+        if signature[0] is not None:
+            with open(config_path, 'r', encoding="UTF-8") as file_pointer:
+                config = parse_tower_env(file_pointer.read())
+        packages = ()
+        if signature[1] is not None:
+            with open(world_path, 'r', encoding="UTF-8") as file_pointer:
+                packages = tuple(file_pointer.read().strip().split("\n"))
+        return HostRecord(host, host_dir, signature, config, packages)
+
+    def get(self, host):
+        # two stat() calls per lookup, files are read again only when they change
+        _, config_path, world_path = self.paths(host)
+        signature = (file_signature(config_path), file_signature(world_path))
+        with self.lock:
+            record = self.records.get(host)
+            if record is None or record.signature != signature:
+                record = self.load(host, signature)
+                self.records[host] = record
+            return record
+
+    def config(self, host):
+        record = self.get(host)
+        if record.config is None:
+            raise FileNotFoundError(os.path.join(self.hosts_dir, host, 'tower.env'))
+        return dict(record.config)
+
+    def color_code(self, host):
+        return self.get(host).color_code
+
+    def is_online(self, host):
+        return self.get(host).online
+
+    def ip(self, host):
+        return self.get(host).ip
+
+    def version(self, host):
+        return self.get(host).version
+
+    def packages(self, host):
+        return list(self.get(host).packages)
+
+    def forget(self, host):
+        with self.lock:
+            self.records.pop(host, None)
+
+
+registry = HostRegistry()
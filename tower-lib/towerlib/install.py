@@ -1,17 +1,19 @@
 import os
 import logging
 import sys
+import tempfile
 import time
 
 from rich.prompt import Confirm
 from rich.text import Text
 
-from towerlib.utils.shell import ssh, scp, rm, Command, ErrorReturnCode
+from towerlib.utils.shell import ssh, scp, rm, apk, openssl, abuild_sign, Command, ErrorReturnCode
 from towerlib.utils import clitask
 from towerlib.utils.menu import add_installed_package, get_installed_packages
 from towerlib.sshconf import is_online_host
 from towerlib.utils.exceptions import LockException, TowerException
-from towerlib import sshconf, config
+from towerlib import sshconf, config, apkcache
+from towerlib.hostregistry import registry
 
 logger = logging.getLogger('tower')
 APK_REPOS_HOST = "dl-cdn.alpinelinux.org"
@@ -20,6 +22,8 @@ APK_REPOS_URL = [
     f"http://{APK_REPOS_HOST}/alpine/{config.HOST_ALPINE_BRANCH}/community",
 ]
 LOCAL_TUNNELING_PORT = 8666
+HOST_ARCH = "aarch64"
+BAKED_PACKAGES_DIR = ".tower-apks" # in the host home, preserved by the upgrade
 
 
 def sprint(value):
@@ -162,7 +166,7 @@ def install_in_thinclient(packages):
 
 
 def can_install(host):
-    if host != "thinclient" and not sshconf.is_up(host):
+    if host != "thinclient" and not sshconf.is_up(host, authenticated=True):
         raise TowerException(f"`{host}` is down. Please start it first.")
     if (host == "thinclient" or not sshconf.is_online_host(host)) and not sshconf.exists(config.ROUTER_HOSTNAME):
         raise TowerException(f"`{host}` is an offline host and `{config.ROUTER_HOSTNAME}` host was not found. Please provision it first.")
@@ -191,3 +195,57 @@ def reinstall_all_packages(host):
     packages = get_installed_packages(host)
     if packages:
         install_packages(host, packages)
+
+
+def baked_repo_path(host):
+    return os.path.join(config.TOWER_DIR, 'hosts', host, 'apks')
+
+
+@clitask("Downloading packages of {0}...")
+def bake_host_packages(host, packages):
+    repo_path = baked_repo_path(host)
+    arch_path = os.path.join(repo_path, HOST_ARCH)
+    rm('-rf', repo_path)
+    os.makedirs(arch_path)
+    # same cache as the TowerOS-Host builds
+    with tempfile.TemporaryDirectory() as root:
+        package_paths = apkcache.fetch_packages(config.HOST_ALPINE_BRANCH, HOST_ARCH, root, packages)
+    apkcache.link_packages(package_paths, arch_path)
+    # index signed with a new key, copied in the boot partition with the other host keys
+    key_path = registry.get(host).paths.apk_key
+    openssl('genrsa', '-out', key_path, '2048')
+    openssl('rsa', '-in', key_path, '-pubout', '-out', f"{key_path}.pub")
+    apk_index_path = os.path.join(arch_path, 'APKINDEX.tar.gz')
+    apk(
+        'index', '--arch', HOST_ARCH, '--rewrite-arch', HOST_ARCH, '--allow-untrusted',
+        '-o', apk_index_path, *[os.path.join(arch_path, os.path.basename(path)) for path in package_paths],
+        _out=logger.debug
+    )
+    abuild_sign('-k', key_path, apk_index_path, _out=logger.debug)
+    with open(os.path.join(repo_path, 'world'), 'w', encoding="UTF-8") as file_pointer:
+        file_pointer.write("\n".join(packages))
+    return repo_path
+
+
+def bake_packages(hosts):
+    # the packages are downloaded through `router` before the hosts are upgraded
+    hosts_packages = {host: [package for package in get_installed_packages(host) if package] for host in hosts}
+    hosts_packages = {host: packages for host, packages in hosts_packages.items() if packages}
+    if not hosts_packages:
+        return {}
+    can_install("thinclient")
+    baked_repos = {}
+    try:
+        prepare_offline_host("thinclient")
+        open_router_tunnel()
+        for host, packages in hosts_packages.items():
+            baked_repos[host] = bake_host_packages(host, packages)
+    finally:
+        cleanup("thinclient")
+    return baked_repos
+
+
+@clitask("Copying packages in {0}...")
+def copy_baked_packages(host, repo_path):
+    ssh(host, f"rm -rf {BAKED_PACKAGES_DIR}")
+    scp('-r', repo_path, f"{host}:{BAKED_PACKAGES_DIR}")
@@ -0,0 +1,42 @@
+#!/bin/sh -e
+
+# prebuilt root filesystem extracted by install-host.sh instead of installing the packages on first boot
+# run as root on the aarch64 builder, where the packages triggers (mkinitfs...) can be executed
+
+REPO_PATH="$(realpath "$1")"
+KEY_PATH="$(realpath "$2")"
+ARCHIVE_PATH="$(realpath "$3")"
+shift 3
+
+cleanup() {
+	umount "$tmp"/proc "$tmp"/dev 2>/dev/null || true
+	rm -rf "$tmp"
+}
+
+# cleanup on exit
+tmp="$(mktemp -d)"
+trap cleanup EXIT
+
+# same initramfs features as install-host.sh, used by the kernel trigger
+# the installer generates the initramfs again, with the LUKS key of the host
+mkdir -p "$tmp"/etc/mkinitfs
+echo 'features="base mmc usb ext4 mmc vfat nvme vmd lvm cryptsetup cryptkey"' > "$tmp"/etc/mkinitfs/mkinitfs.conf
+
+# apk reads the keys from the target root
+mkdir -p "$tmp"/etc/apk/keys
+cp /etc/apk/keys/* "$tmp"/etc/apk/keys/
+cp "$KEY_PATH" "$tmp"/etc/apk/keys/
+
+# init chroot
+mkdir -p "$tmp"/proc "$tmp"/dev
+mount --bind /proc "$tmp"/proc
+mount --bind /dev "$tmp"/dev
+
+# install packages
+apk add --root "$tmp" --initdb --quiet --no-network --clean-protected --repository "$REPO_PATH" "$@"
+
+# clean chroot
+umount "$tmp"/proc "$tmp"/dev
+
+# generate archive
+tar -c -C "$tmp" --numeric-owner . | zstd -19 -T0 -q -f -o "$ARCHIVE_PATH"
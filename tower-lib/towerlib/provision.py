@@ -1,15 +1,16 @@
 import os
 import secrets
 import logging
-import tempfile
 import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
-from passlib.hash import sha512_crypt
 from rich.prompt import Confirm, Prompt
 from rich.text import Text
+from rich.table import Table
 from rich import print as rprint
 
-from towerlib.utils.shell import ssh_keygen, xz, ssh, cp, dd, scp, Command, doas
+from towerlib.utils.shell import ssh_keygen, ssh, dd, scp, Command, doas
 from towerlib import utils, buildhost, sshconf, config, install
 from towerlib.utils.exceptions import (
     DiscoveringTimeOut,
@@ -60,6 +61,7 @@ def prepare_host_config(host, args):
     check_environment_value('public-key-path', args.public_key_path)
     with open(args.public_key_path, encoding="UTF-8") as file_pointer:
         public_key = file_pointer.read().strip()
+    from passlib.hash import sha512_crypt
     # generate random password
     password = args.password or secrets.token_urlsafe(16)
     # gather locale informations
@@ -114,22 +116,9 @@ def prepare_host_config(host, args):
     }
 
 
-@utils.clitask("Decompressing {0}...", sudo=True)
-def decompress_image(image_path):
-    out_file = image_path.replace('.xz', '')
-    tmp_file = os.path.join(tempfile.gettempdir(), os.path.basename(out_file))
-    xz('--stdout', '-d', image_path, _out=tmp_file)
-    cp(tmp_file, out_file)
-    return out_file
-
-
 def prepare_host_image(image_arg):
-    image_path = image_arg if image_arg and os.path.isfile(image_arg) else utils.find_host_image()
-    if image_path:
-        ext = image_path.split(".").pop()
-        if ext == 'xz':
-            image_path = decompress_image(image_path)
-    return image_path
+    # compressed images are decompressed on the fly while being written
+    return image_arg if image_arg and os.path.isfile(image_arg) else utils.find_host_image()
 
 
 def find_no_root_device(host):
@@ -309,6 +298,53 @@ def get_upgradable_hosts():
     return upgradable_hosts, no_upgradable_host
 
 
+def upgrade_host(host, params, args, packages_lock):
+    # runs in its own thread: named after the host to prefix the tasks output
+    threading.current_thread().name = host
+    stage = "burn"
+    try:
+        # packages installed with the system, from the home volume
+        if params.get('baked_repo'):
+            stage = "packages copy"
+            install.copy_baked_packages(host, params['baked_repo'])
+            stage = "burn"
+        # copy TowerOS-Host image to boot device and reboot
+        buildhost.burn_image_in_host(host, params['image_path'], params['boot_device'], params['install_config'], args.zero_device)
+        # save necessary files in thin client
+        stage = "configuration"
+        prepare_thin_client(host, params['host_config'], params['private_key_path'])
+        if args.no_wait:
+            return host, "burned", None
+        # wait for host to be ready
+        stage = "wait"
+        wait_for_host(host, args.timeout)
+        # sync time
+        stage = "time sync"
+        if params['host_config']['ONLINE'] == 'false':
+            sshconf.sync_time(host)
+        if params.get('baked_repo'):
+            return host, "upgraded", None
+        # re-install packages, one host at a time: offline installs share the router tunnel
+        stage = "packages"
+        with packages_lock:
+            install.reinstall_all_packages(host)
+        return host, "upgraded", None
+    except Exception as exc: # pylint: disable=broad-exception-caught
+        # one failing host must not stop the others
+        logger.debug("Upgrade of %s failed", host, exc_info=True)
+        return host, f"failed ({stage})", str(exc)
+
+
+def display_upgrade_summary(results):
+    table = Table(title="Upgrade summary")
+    table.add_column("Host", style="cyan")
+    table.add_column("Status")
+    table.add_column("Error", style="red")
+    for host, status, error in results:
+        table.add_row(host, Text(status, style='green' if error is None else 'red'), error or "")
+    rprint(table)
+
+
 @utils.clitask("Upgrading {0}...", timer_message="Host(s) upgraded in {0}.", task_parent=True)
 def upgrade_hosts(hosts, args):
     host_params = {}
@@ -333,33 +369,25 @@ def upgrade_hosts(hosts, args):
     if not args.no_confirm and not Confirm.ask("Do you want to continue?", default=True):
         return
 
+    baked_repos = install.bake_packages(hosts) if args.bake_packages else {}
     for host in hosts:
-        # copy TowerOS-Host image to boot device
-        buildhost.burn_image_in_host(
-            host,
-            host_params[host]['image_path'],
-            host_params[host]['boot_device'],
-            host_params[host]['host_config'],
-            args.zero_device
-        )
-        # save necessary files in thin client
-        prepare_thin_client(
-            host,
-            host_params[host]['host_config'],
-            host_params[host]['private_key_path']
-        )
+        host_params[host]['baked_repo'] = baked_repos.get(host)
+        # read by the installer of this upgrade, which adds the packages to the new system: not saved with the host configuration
+        host_params[host]['install_config'] = {
+            **host_params[host]['host_config'], 'BAKED_PACKAGES': 'true' if host in baked_repos else 'false'
+        }
 
-    # wait for host to be ready
-    if not args.no_wait:
-        wait_for_hosts(hosts, args.timeout)
-        for host in hosts:
-             # sync time
-            if host_params[host]['host_config']['ONLINE'] == 'false':
-                sshconf.sync_time(host)
-            # re-install packages
-            install.reinstall_all_packages(host)
-    else:
+    # each host goes through all the stages on its own, as soon as the previous one is done
+    packages_lock = threading.Lock()
+    with ThreadPoolExecutor(max_workers=args.parallel) as executor:
+        futures = [executor.submit(upgrade_host, host, host_params[host], args, packages_lock) for host in hosts]
+        results = [future.result() for future in futures]
+    display_upgrade_summary(results)
+    if args.no_wait and not args.bake_packages:
         rprint(Text("WARNING: Packages were not re-installed. Please re-install them manually when hosts are ready", style='red'))
+    failed_hosts = [host for host, _, error in results if error is not None]
+    if failed_hosts:
+        raise TowerException(f"Upgrade failed for {', '.join(failed_hosts)}. Run `tower upgrade --hosts {' '.join(failed_hosts)}` to try again.")
 
 
 @utils.clitask("Downloading releases file...")
@@ -391,7 +419,8 @@ def upgrade_thinclient(args):
     with doas:
         if args.zero_device:
             buildhost.zeroing_device(install_device)
-        buildhost.copy_image_in_device(latest_release_path, install_device)
+        # the thin client reboots on this device: read it back before
+        buildhost.copy_image_in_device(latest_release_path, install_device, verify=True)
     warning_message = f"WARNING: This will completely wipe the install device `{install_device}` plugged into the thin client."
     warning_message += "\nWARNING: This will completely re-install TowerOS on the thin client. Your home directory will be preserved."
     rprint(Text(warning_message, style='red'))
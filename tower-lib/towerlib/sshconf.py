@@ -1,15 +1,20 @@
 import os
+import asyncio
+import json
 import logging
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError as FuturesTimeoutError
 
-from rich.console import Console
-from rich.table import Table
-from rich.text import Text
 from sshconf import read_ssh_config, empty_ssh_config_file
 
-from towerlib.utils.shell import ssh, ErrorReturnCode, sed, touch, Command
+from towerlib.utils.shell import (
+    ssh, ssh_master, ErrorReturnCode, ErrorReturnCode_2, ErrorReturnCode_255, TimeoutException, sed, touch, Command,
+)
 from towerlib.utils import clitask
+from towerlib.utils.blockio import format_size
 from towerlib.utils.exceptions import DiscoveringTimeOut, UnkownHost, InvalidColor
+from towerlib.hostregistry import registry
 from towerlib.__about__ import __version__
 from towerlib.config import (
     SSH_CONFIG_PATH,
@@ -20,10 +25,21 @@ from towerlib.config import (
     KNOWN_HOSTS_PATH,
     COLORS,
     ROUTER_HOSTNAME,
+    STATUS_TIMEOUT,
+    SSH_PROBE_TIMEOUT,
+    SSH_PROBE_INTERVAL,
+    STATUS_SNAPSHOT_PATH,
+    STATUS_SNAPSHOT_MAX_AGE,
 )
 
 logger = logging.getLogger('tower')
 
+HOST_STATUS_SCRIPT = "/var/towercomputers/scripts/host_status.py"
+
+# parsed once per process and reloaded when the config file changes
+_ssh_config_index = {'signature': None, 'by_name': {}, 'by_ip': {}}
+_ssh_config_lock = threading.Lock()
+
 
 def create_ssh_dir():
     ssh_dir = os.path.dirname(SSH_CONFIG_PATH)
@@ -53,11 +69,41 @@ def ssh_config():
     return read_ssh_config(TOWER_SSH_CONFIG_PATH) if os.path.exists(TOWER_SSH_CONFIG_PATH) else empty_ssh_config_file()
 
 
+def ssh_config_signature():
+    try:
+        stat = os.stat(TOWER_SSH_CONFIG_PATH)
+    except FileNotFoundError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+
+def index_ssh_config(config, signature):
+    by_name = {host: config.host(host) for host in config.hosts()}
+    by_ip = {host_config['hostname']: host for host, host_config in by_name.items() if 'hostname' in host_config}
+    _ssh_config_index.update(signature=signature, by_name=by_name, by_ip=by_ip)
+
+
+def ssh_config_index():
+    signature = ssh_config_signature()
+    with _ssh_config_lock:
+        if signature != _ssh_config_index['signature']:
+            index_ssh_config(ssh_config(), signature)
+        return _ssh_config_index
+
+
+def write_ssh_config(config):
+    config.write(TOWER_SSH_CONFIG_PATH)
+    with _ssh_config_lock:
+        index_ssh_config(config, ssh_config_signature())
+
+
 def get(host):
-    config = ssh_config()
-    if host in config.hosts():
-        return config.host(host)
-    return None
+    host_config = ssh_config_index()['by_name'].get(host)
+    return dict(host_config) if host_config is not None else None
+
+
+def get_by_ip(host_ip):
+    return ssh_config_index()['by_ip'].get(host_ip)
 
 
 def update_known_hosts(host, host_ip):
@@ -80,18 +126,18 @@ def update_config(host, host_ip, private_key_path):
     existing_hosts = config.hosts()
     # if name already used, update the IP
     if host in existing_hosts:
+        close_connection(host)
         config.set(host, Hostname=host_ip)
         config.set(host, IdentityFile=private_key_path)
-        config.write(TOWER_SSH_CONFIG_PATH)
+        write_ssh_config(config)
         return
     # if IP already used, update the name
-    for existing_host in existing_hosts:
-        existing_host_config = config.host(existing_host)
-        if existing_host_config['hostname'] == host_ip:
-            config.rename(existing_host, host)
-            config.set(host, IdentityFile=private_key_path)
-            config.write(TOWER_SSH_CONFIG_PATH)
-            return
+    existing_host = get_by_ip(host_ip)
+    if existing_host in existing_hosts:
+        config.rename(existing_host, host)
+        config.set(host, IdentityFile=private_key_path)
+        write_ssh_config(config)
+        return
     # if not exists, create a new host
     config.add(host,
         Hostname=host_ip,
@@ -102,7 +148,7 @@ def update_config(host, host_ip, private_key_path):
     )
     if not os.path.exists(TOWER_DIR):
         os.makedirs(TOWER_DIR)
-    config.write(TOWER_SSH_CONFIG_PATH)
+    write_ssh_config(config)
 
 
 @clitask("Updating ssh config with ConnectTimeout=1...")
@@ -110,11 +156,11 @@ def add_connect_timeout():
     config = ssh_config()
     for host in config.hosts():
         config.set(host, ConnectTimeout=1)
-    config.write(TOWER_SSH_CONFIG_PATH)
+    write_ssh_config(config)
 
 
 def hosts():
-    hosts_list = sorted(ssh_config().hosts())
+    hosts_list = sorted(ssh_config_index()['by_name'])
     # put router in first position
     if ROUTER_HOSTNAME in hosts_list:
         router_index = hosts_list.index(ROUTER_HOSTNAME)
@@ -128,135 +174,316 @@ def exists(host):
 
 def is_online_host(host):
     if exists(host):
-        return get_host_config_value(host, 'ONLINE') == 'true'
+        return registry.is_online(host)
     raise UnkownHost(f"Unknown host: {host}")
 
 
-def is_up(host):
+async def sshd_answers(host):
+    # sshd sends its banner before any authentication, hosts drop ICMP so we can't ping them
+    host_ssh_config = get(host)
+    try:
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(host_ssh_config['hostname'], int(host_ssh_config.get('port', 22))),
+            SSH_PROBE_TIMEOUT
+        )
+    except (OSError, asyncio.TimeoutError):
+        return False
+    try:
+        banner = await asyncio.wait_for(reader.readline(), SSH_PROBE_TIMEOUT)
+    except (OSError, asyncio.TimeoutError):
+        return False
+    finally:
+        writer.close()
+    return banner.startswith(b'SSH-')
+
+
+def accepts_ssh_session(host):
+    try:
+        ssh(host, 'true')
+    except ErrorReturnCode:
+        return False
+    return True
+
+
+async def probe(host, authenticated = False):
+    if not await sshd_answers(host):
+        return False
+    if authenticated:
+        return await asyncio.to_thread(accepts_ssh_session, host)
+    return True
+
+
+def is_up(host, authenticated = False):
     if exists(host):
-        try:
-            ssh(host, 'ls') # Running a command over SSH command should tell us if the host is up.
-        except ErrorReturnCode:
-            return False
-        return True
+        return asyncio.run(probe(host, authenticated))
     raise UnkownHost(f"Unknown host: {host}")
 
 
-def status(host = None, full = True):
+# the first multiplexed command to a host starts its master connection, `ControlPersist` ends it when idle
+def connection_is_alive(host):
+    return ssh_master(host, 'check').exit_code == 0
+
+
+def close_connection(host):
+    if connection_is_alive(host):
+        ssh_master(host, 'exit')
+
+
+def host_summary(host, host_status):
+    online = is_online_host(host)
+    host_ssh_config = get(host)
+    return {
+        'name': host,
+        'status': host_status,
+        'online-host': online,
+        'ip': host_ssh_config['hostname'],
+        'toweros-version': registry.version(host),
+        'color': get_host_color_name(host),
+    }
+
+
+METRICS_KEYS = ['system', 'memory-usage', 'memory-total', 'cpu-usage', 'cpu-temperature']
+
+
+def legacy_host_metrics(host, timeout = None):
+    # TowerOS-Host versions without `host_status.py`
+    inxi_info = ssh('-t', host, 'inxi', '-MIs', '-c', '0', _timeout=timeout).strip()
+    memory_available = inxi_info[inxi_info.index('available: ') + 11:inxi_info.index(' used:')].strip()
+    memory_used = inxi_info[inxi_info.index('used: ') + 6:inxi_info.index(' Init:')].strip()
+    return {
+        'system': inxi_info[inxi_info.index('System: ') + 8:inxi_info.index(' details:')],
+        'memory-usage': memory_used,
+        'memory-total': memory_available,
+        'cpu-usage': str(round(100 - float(ssh(host, 'mpstat', _timeout=timeout).strip().split("\n")[-1].split(" ")[-1]), 2)) + "%",
+        'cpu-temperature': inxi_info[inxi_info.index('cpu: ') + 5:inxi_info.index(' mobo: ')].strip(),
+    }
+
+
+def get_host_metrics(host, timeout = None):
+    # one ssh round trip to know if the host is up and get its metrics
+    # `timeout`: the ssh process is killed, a hung probe does not outlive the status deadline
+    try:
+        metrics = json.loads(ssh(host, 'python3', HOST_STATUS_SCRIPT, _timeout=timeout).strip())
+    except ErrorReturnCode_2:
+        return legacy_host_metrics(host, timeout)
+    except ErrorReturnCode_255:
+        # ssh could not connect
+        return None
+    memory_percent = round(metrics['memory-used'] * 100 / metrics['memory-total'], 1)
+    temperature = metrics['cpu-temperature']
+    return {
+        'system': metrics['system'] or 'N/A',
+        'memory-usage': f"{format_size(metrics['memory-used'])} ({memory_percent}%)",
+        'memory-total': format_size(metrics['memory-total']),
+        'cpu-usage': f"{metrics['cpu-usage']}%",
+        'cpu-temperature': f"{temperature} C" if temperature is not None else 'N/A',
+    }
+
+
+def unavailable_status(host, host_status, full):
+    # same keys as a complete status, without the metrics
+    host_info = host_summary(host, host_status)
+    if full:
+        host_info.update({key: 'N/A' for key in METRICS_KEYS})
+        host_info['packages-installed'] = ', '.join(get_installed_packages(host))
+    return host_info
+
+
+def full_status(host, timeout = None):
+    try:
+        metrics = get_host_metrics(host, timeout)
+    except TimeoutException:
+        return unavailable_status(host, 'unknown', True)
+    except ErrorReturnCode as exc:
+        # the host answered but the probe failed
+        logger.warning("Status probe failed in %s: %s", host, exc.stderr.decode('utf-8', 'ignore').strip())
+        return unavailable_status(host, 'error', True)
+    except ValueError:
+        logger.warning("Invalid status probe output in %s", host)
+        return unavailable_status(host, 'error', True)
+    if not metrics:
+        return unavailable_status(host, 'down', True)
+    host_info = host_summary(host, 'up')
+    host_info.update(metrics)
+    host_info['packages-installed'] = ', '.join(get_installed_packages(host))
+    return host_info
+
+
+def status(host = None, full = True, timeout = None):
     if host:
-        host_ssh_config = get(host)
-        host_config = get_host_config(host)
-        host_status = 'up' if is_up(host) else 'down'
-        online = is_online_host(host)
-        host_info = {
-            'name': host,
-            'status': host_status,
-            'online-host': online,
-            'ip': host_ssh_config['hostname'],
-            'toweros-version': host_config.get('TOWEROS_VERSION', 'N/A'),
-            'color': get_host_color_name(host),
-        }
-        if full:
-            if host_status == 'up':
-                inxi_info = ssh('-t', host, 'inxi', '-MIs', '-c', '0').strip()
-                host_info['system'] = inxi_info[inxi_info.index('System: ') + 8:inxi_info.index(' details:')]
-                memory_available = inxi_info[inxi_info.index('available: ') + 11:inxi_info.index(' used:')].strip()
-                memory_used = inxi_info[inxi_info.index('used: ') + 6:inxi_info.index(' Init:')].strip()
-                host_info['memory-usage'] = memory_used
-                host_info['memory-total'] = memory_available
-                host_info['cpu-usage'] = str(round(100 - float(ssh(host, 'mpstat').strip().split("\n")[-1].split(" ")[-1]), 2)) + "%"
-                host_info['cpu-temperature'] = inxi_info[inxi_info.index('cpu: ') + 5:inxi_info.index(' mobo: ')].strip()
-            else:
-                host_info['system'] = 'N/A'
-                host_info['memory-usage'] = 'N/A'
-                host_info['memory-total'] = 'N/A'
-                host_info['cpu-usage'] = 'N/A'
-                host_info['cpu-temperature'] = 'N/A'
-            host_info['packages-installed'] = ', '.join(get_installed_packages(host))
-        return host_info
-    return [status(host, False) for host in hosts()]
-
-
-def display_status(host = None):
-    all_status = status(host)
+        if not full:
+            return host_summary(host, 'up' if is_up(host) else 'down')
+        return full_status(host, timeout)
+    hosts_list = hosts()
+    return sorted(iter_status(hosts_list, False), key=lambda host_info: hosts_list.index(host_info['name']))
+
+
+def future_status(future, host, full):
+    # a failing host must not hide the others
+    try:
+        return future.result()
+    except Exception as exc: # pylint: disable=broad-exception-caught
+        logger.debug("Status of %s failed", host, exc_info=exc)
+        return unavailable_status(host, 'error', full)
+
+
+def iter_status(hosts_list = None, full = False, timeout = STATUS_TIMEOUT, executor = None):
+    # yield the status of each host as soon as it answers
+    # `executor`: shared by the callers sampling the hosts in a loop
+    hosts_list = hosts() if hosts_list is None else hosts_list
+    if len(hosts_list) == 0:
+        return
+    own_executor = executor is None
+    if own_executor:
+        executor = ThreadPoolExecutor(max_workers=len(hosts_list))
+    futures = {executor.submit(status, host, full, timeout or None): host for host in hosts_list}
+    pending = set(futures)
+    try:
+        for future in as_completed(futures, timeout=timeout or None):
+            pending.remove(future)
+            yield future_status(future, futures[future], full)
+    except FuturesTimeoutError:
+        logger.debug("Status deadline of %ss exceeded", timeout)
+        for future in futures:
+            if future in pending:
+                yield future_status(future, futures[future], full) if future.done() else unavailable_status(futures[future], 'unknown', full)
+    finally:
+        for future in pending:
+            future.cancel()
+        if own_executor:
+            executor.shutdown(wait=False)
+
+
+def load_status_snapshot(max_age = STATUS_SNAPSHOT_MAX_AGE):
+    # latest sample written by the `tower-status` service, if recent and complete
+    try:
+        with open(STATUS_SNAPSHOT_PATH, 'r', encoding="UTF-8") as file_pointer:
+            snapshot = json.load(file_pointer)
+    except (FileNotFoundError, ValueError):
+        return None
+    if time.time() - snapshot['time'] > max_age:
+        return None
+    if set(snapshot['hosts']) != set(hosts()):
+        return None
+    return snapshot['hosts']
+
+
+def summary_status(host_status):
+    summary_keys = ['name', 'status', 'online-host', 'ip', 'toweros-version', 'color']
+    return {key: host_status[key] for key in summary_keys}
+
+
+def status_row(host_status):
+    from rich.text import Text
+    values = [str(value) for value in host_status.values()]
+    values[0] = Text(values[0], style="bold")
+    values[1] = Text(values[1], style=status_color(values[1]))
+    online_color = "yellow" if values[2] == "True" else ("blue" if values[2] == "False" else "white")
+    values[2] = Text(values[2], style=online_color)
+    values[5] = Text(values[5], style=values[5].lower())
+    return values
+
+
+def status_color(host_status):
+    if host_status == "up":
+        return "green"
+    return "red" if host_status == "down" else "yellow"
+
+
+def display_host_status(host_status):
+    from rich.console import Console
+    from rich.table import Table
+    from rich.text import Text
+    table = Table(show_header=False)
+    table.add_column("key")
+    table.add_column("value")
+    for key in host_status.keys():
+        value = str(host_status[key])
+        if key == "name":
+            value = Text(value, style="bold")
+        elif key == "status":
+            value = Text(value, style=status_color(value))
+        elif key == "online-host":
+            value = Text(value, style="yellow" if value == "True" else ("blue" if value == "False" else "white"))
+        elif key == "color":
+            value = Text(value, style=value.lower())
+        table.add_row(key, value)
+    Console().print(table)
+
+
+def display_status(host = None, timeout = STATUS_TIMEOUT, refresh = False):
+    from rich.console import Console
+    from rich.live import Live
+    from rich.table import Table
+    snapshot = None if refresh else load_status_snapshot()
     if host:
-        all_status = [all_status]
-    if len(all_status) == 0:
+        display_host_status(snapshot[host] if snapshot else status(host, timeout=timeout or None))
+        return
+    hosts_list = hosts()
+    if len(hosts_list) == 0:
         print("No host found.")
         return
-    table = Table(show_header=len(all_status) > 1)
-    if len(all_status) > 1:
-        headers = all_status[0].keys()
-        for column in headers:
+    if len(hosts_list) == 1:
+        host_status = summary_status(snapshot[hosts_list[0]]) if snapshot else status(hosts_list[0], False)
+        display_host_status(host_status)
+        return
+    if snapshot:
+        table = Table()
+        for column in summary_status(snapshot[hosts_list[0]]).keys():
             table.add_column(column)
-        for host_status in all_status:
-            values = [str(value) for value in host_status.values()]
-            values[0] = Text(values[0], style="bold")
-            values[1] = Text(values[1], style="red" if values[1] == "down" else "green")
-            online_color = "yellow" if values[2] == "True" else ("blue" if values[2] == "False" else "white")
-            values[2] = Text(values[2], style=online_color)
-            values[5] = Text(values[5], style=values[5].lower())
-            table.add_row(*values)
-    else:
-        table.add_column("key")
-        table.add_column("value")
-        for key in all_status[0].keys():
-            value = str(all_status[0][key])
-            if key == "name":
-                value = Text(value, style="bold")
-            elif key == "status":
-                value = Text(value, style="red" if value == "down" else "green")
-            elif key == "online-host":
-                value = Text(value, style="yellow" if value == "True" else ("blue" if value == "False" else "white"))
-            elif key == "color":
-                value = Text(value, style=value.lower())
-            table.add_row(key, value)
-    console = Console()
-    console.print(table)
+        for host_name in hosts_list:
+            table.add_row(*status_row(summary_status(snapshot[host_name])))
+        Console().print(table)
+        return
+    # add rows to the table as soon as hosts answer
+    table = None
+    with Live(console=Console()) as live:
+        for host_status in iter_status(hosts_list, False, timeout):
+            if table is None:
+                table = Table()
+                for column in host_status.keys():
+                    table.add_column(column)
+                live.update(table)
+            table.add_row(*status_row(host_status))
+            live.refresh()
 
 
 def get_next_host_ip(tower_network, first=FIRST_HOST_IP):
     network = ".".join(tower_network.split(".")[0:3]) + "."
-    for host_name in hosts():
-        host_ip = get(host_name)['hostname']
-        if host_ip.startswith(network):
-            num = int(host_ip.split(".").pop())
-            if num == first:
-                first += 1
-                return get_next_host_ip(tower_network, first=first + 1)
+    used_ips = ssh_config_index()['by_ip']
+    while f"{network}{first}" in used_ips:
+        first += 2
     return f"{network}{first}"
 
 
+async def wait_for_sshd(host):
+    # a confirmed host is not probed anymore
+    while not await probe(host, authenticated=True):
+        await asyncio.sleep(SSH_PROBE_INTERVAL)
+
+
+async def wait_for_all_sshd(hosts_list, timeout):
+    tasks = [asyncio.create_task(wait_for_sshd(host)) for host in hosts_list]
+    _, pending = await asyncio.wait(tasks, timeout=timeout or None)
+    for task in pending:
+        task.cancel()
+    return len(pending) == 0
+
+
 @clitask("Waiting for host to be ready...")
 def wait_for_host_sshd(host, timeout):
-    start_time = time.time()
-    while not is_up(host):
-        duration = time.time() - start_time
-        if timeout and duration > timeout:
-            raise DiscoveringTimeOut("Host discovery timeout")
-        time.sleep(3)
+    if not asyncio.run(wait_for_all_sshd([host], timeout)):
+        raise DiscoveringTimeOut("Host discovery timeout")
 
 
 @clitask("Waiting for host(s) {0} to be ready...")
 def wait_for_hosts_sshd(hosts_list, timeout):
-    start_time = time.time()
-    while not all((is_up(host) for host in hosts_list)):
-        duration = time.time() - start_time
-        if timeout and duration > timeout:
-            raise DiscoveringTimeOut("Hosts discovery timeout")
-        time.sleep(3)
+    if not asyncio.run(wait_for_all_sshd(hosts_list, timeout)):
+        raise DiscoveringTimeOut("Hosts discovery timeout")
 
 
 def get_host_config(host):
-    conf_path = os.path.join(TOWER_DIR, 'hosts', host, "tower.env")
-    with open(conf_path, 'r', encoding="UTF-8") as file_pointer:
-        config_str = file_pointer.read()
-    host_config = {}
-    for line in config_str.strip().split("\n"):
-        key = line[0:line.index('=')]
-        value = line[line.index('=') + 2:-1]
-        host_config[key] = value
-    return host_config
+    return registry.config(host)
 
 
 def get_host_config_value(host, key):
@@ -270,8 +497,7 @@ def get_version():
         "hosts": {}
     }
     for host_name in hosts():
-        host_config = get_host_config(host_name)
-        versions['hosts'][host_name] = host_config.get('TOWEROS_VERSION', 'N/A')
+        versions['hosts'][host_name] = registry.version(host_name)
     return versions
 
 
@@ -302,8 +528,7 @@ def get_next_color_name():
 
 
 def get_host_color_name(host):
-    host_config = get_host_config(host)
-    host_color_code = int(host_config.get('COLOR', COLORS[0][0]))
+    host_color_code = registry.color_code(host)
     for color in COLORS:
         if color[0] == host_color_code:
             return color[1]
@@ -311,16 +536,11 @@ def get_host_color_name(host):
 
 
 def get_hex_host_color(host):
-    host_config = get_host_config(host)
-    host_color_code= int(host_config.get('COLOR', COLORS[0][0]))
-    return color_hex(host_color_code)
+    return color_hex(registry.color_code(host))
 
 
 def get_installed_packages(host):
-    apk_world = os.path.join(TOWER_DIR, 'hosts', host, 'world')
-    if os.path.exists(apk_world):
-        return open(apk_world, 'r', encoding="UTF-8").read().strip().split("\n")
-    return []
+    return registry.packages(host)
 
 
 def save_installed_packages(host, installed_packages):
@@ -334,7 +554,7 @@ def sync_time(offline_host = None):
     if not exists(ROUTER_HOSTNAME):
         return
     all_hosts = hosts() if not offline_host else [offline_host]
-    offline_hosts =  [host for host in all_hosts if not is_online_host(host) and is_up(host)]
+    offline_hosts =  [host for host in all_hosts if not is_online_host(host) and is_up(host, authenticated=True)]
     if len(offline_hosts) == 0:
         return
     # update offline host time
@@ -351,6 +571,7 @@ def sync_time(offline_host = None):
 def poweroff_host(host):
     if is_up(host):
         ssh(host, 'sudo poweroff')
+        close_connection(host)
 
 
 def poweroff(host=None):
@@ -365,15 +586,17 @@ def poweroff(host=None):
 def delete_host_config(host):
     if not exists(host):
         return
+    close_connection(host)
     config = ssh_config()
     host_ip = config.host(host)['hostname']
     config.remove(host)
-    config.write(TOWER_SSH_CONFIG_PATH)
+    write_ssh_config(config)
     if os.path.exists(KNOWN_HOSTS_PATH):
         sed('-i', f'/{host_ip}/d', KNOWN_HOSTS_PATH)
     host_dir = os.path.join(TOWER_DIR, 'hosts', host)
     if os.path.exists(host_dir):
         Command('sh')('-c', f"rm -rf {host_dir}")
+    registry.forget(host)
     status_file = os.path.join(TOWER_DIR, f'{host}_status')
     if os.path.exists(status_file):
         Command('sh')('-c', f"rm -f {status_file}")
@@ -0,0 +1,446 @@
+#!/usr/bin/env python3
+
+# Only depends on the standard library: this file is also copied and executed on the hosts.
+
+import argparse
+import fcntl
+import hashlib
+import io
+import lzma
+import mmap
+import os
+import queue
+import subprocess # nosec B404
+import sys
+import threading
+import time
+import xml.etree.ElementTree as ET # nosec B405
+from datetime import timedelta
+
+BMAP_BLOCK_SIZE = 4096
+BMAP_CHECKSUM_TYPE = "sha256"
+BUFFER_SIZE = 4 * 1024 * 1024
+BUFFER_COUNT = 3 # one being read, one being written and one ready
+DIRECT_IO_ALIGN = 4096
+SYNC_INTERVAL = 64 * 1024 * 1024 # bytes
+PROGRESS_INTERVAL = 1 # seconds
+COMPRESSIONS = ['xz', 'zst'] # image file extensions
+
+class BlockIOException(Exception):
+    pass
+
+def mapped_ranges(image_path, block_size=BMAP_BLOCK_SIZE):
+    # ranges of blocks holding data, holes of the sparse image are skipped
+    ranges = []
+    with open(image_path, 'rb') as file_pointer:
+        fd = file_pointer.fileno()
+        image_size = os.fstat(fd).st_size
+        offset = 0
+        while offset < image_size:
+            try:
+                data_start = os.lseek(fd, offset, os.SEEK_DATA)
+            except OSError: # ENXIO: only a hole until the end of the file
+                break
+            data_end = min(os.lseek(fd, data_start, os.SEEK_HOLE), image_size)
+            first_block, last_block = data_start // block_size, (data_end - 1) // block_size
+            if ranges and first_block <= ranges[-1][1] + 1:
+                ranges[-1][1] = max(ranges[-1][1], last_block)
+            else:
+                ranges.append([first_block, last_block])
+            offset = data_end
+    return image_size, ranges
+
+def range_checksum(file_pointer, start, end):
+    hasher = hashlib.new(BMAP_CHECKSUM_TYPE)
+    file_pointer.seek(start)
+    remaining = end - start
+    while remaining > 0:
+        chunk = file_pointer.read(min(BUFFER_SIZE, remaining))
+        hasher.update(chunk)
+        remaining -= len(chunk)
+    return hasher.hexdigest()
+
+def generate_bmap(image_path, block_size=BMAP_BLOCK_SIZE):
+    # bmaptool 2.0 format, can also be used with `bmaptool copy`
+    image_size, ranges = mapped_ranges(image_path, block_size)
+    lines = []
+    mapped_blocks = 0
+    with open(image_path, 'rb') as file_pointer:
+        for first_block, last_block in ranges:
+            start, end = first_block * block_size, min((last_block + 1) * block_size, image_size)
+            checksum = range_checksum(file_pointer, start, end)
+            blocks = f"{first_block}-{last_block}" if last_block > first_block else f"{first_block}"
+            lines.append(f'        <Range chksum="{checksum}"> {blocks} </Range>')
+            mapped_blocks += last_block - first_block + 1
+    bmap = "\n".join([
+        '<?xml version="1.0" ?>',
+        '<bmap version="2.0">',
+        f'    <ImageSize> {image_size} </ImageSize>',
+        f'    <BlockSize> {block_size} </BlockSize>',
+        f'    <BlocksCount> {(image_size + block_size - 1) // block_size} </BlocksCount>',
+        f'    <MappedBlocksCount> {mapped_blocks} </MappedBlocksCount>',
+        f'    <ChecksumType> {BMAP_CHECKSUM_TYPE} </ChecksumType>',
+        f'    <BmapFileChecksum> {"0" * 64} </BmapFileChecksum>',
+        '    <BlockMap>',
+        *lines,
+        '    </BlockMap>',
+        '</bmap>',
+        '',
+    ])
+    # the file checksum is computed with the checksum field filled with zeros
+    return bmap.replace("0" * 64, hashlib.sha256(bmap.encode()).hexdigest(), 1)
+
+def write_bmap(image_path, bmap_path):
+    with open(bmap_path, 'w', encoding="UTF-8") as file_pointer:
+        file_pointer.write(generate_bmap(image_path))
+
+def read_bmap(bmap_path):
+    root = ET.parse(bmap_path).getroot() # nosec B314
+    checksum_type = root.findtext('ChecksumType', BMAP_CHECKSUM_TYPE).strip()
+    block_size = int(root.findtext('BlockSize').strip())
+    ranges = []
+    for block_range in root.find('BlockMap').findall('Range'):
+        blocks = block_range.text.strip().split('-')
+        ranges.append((int(blocks[0]), int(blocks[-1]), block_range.get('chksum')))
+    return {
+        'image_size': int(root.findtext('ImageSize').strip()),
+        'block_size': block_size,
+        'checksum_type': checksum_type,
+        'ranges': ranges,
+    }
+
+def bmap_byte_ranges(bmap):
+    for first_block, last_block, checksum in bmap['ranges']:
+        start = first_block * bmap['block_size']
+        end = min((last_block + 1) * bmap['block_size'], bmap['image_size'])
+        yield start, end, checksum
+
+class ZeroStream(io.RawIOBase):
+    def __init__(self, size):
+        self.remaining = size
+        self.zeros = memoryview(bytes(BUFFER_SIZE))
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = min(len(buffer), self.remaining, BUFFER_SIZE)
+        buffer[:size] = self.zeros[:size]
+        self.remaining -= size
+        return size
+
+class HashingStream(io.RawIOBase):
+    # running checksum of the image as received, before decompression
+    def __init__(self, stream):
+        self.stream = stream
+        self.hasher = hashlib.sha256()
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = self.stream.readinto(buffer)
+        if size:
+            self.hasher.update(memoryview(buffer)[:size])
+        return size
+
+    def hexdigest(self):
+        # the block map can stop the copy before the end of the image
+        with memoryview(bytearray(BUFFER_SIZE)) as trash:
+            while self.readinto(trash):
+                pass
+        return self.hasher.hexdigest()
+
+class ZstdStream(io.RawIOBase):
+    # no zstd in the standard library: decompressed by `zstd -dc`, fed from a thread
+    def __init__(self, stream):
+        self.process = subprocess.Popen(['zstd', '-dcq'], stdin=subprocess.PIPE, stdout=subprocess.PIPE) # pylint: disable=consider-using-with # nosec B603 B607
+        self.feeder = threading.Thread(target=self.feed, args=(stream,), daemon=True)
+        self.feeder.start()
+
+    def feed(self, stream):
+        try:
+            while chunk := stream.read(BUFFER_SIZE):
+                self.process.stdin.write(chunk)
+        except BrokenPipeError:
+            pass
+        finally:
+            self.process.stdin.close()
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        return self.process.stdout.readinto(buffer)
+
+    def close(self):
+        if not self.closed:
+            # let zstd read the whole input, for the checksum of the received stream
+            with memoryview(bytearray(BUFFER_SIZE)) as trash:
+                while self.process.stdout.readinto(trash):
+                    pass
+            self.feeder.join()
+            self.process.stdout.close()
+            if self.process.wait() != 0:
+                raise BlockIOException("zstd decompression failed")
+        super().close()
+
+def image_compression(image_path, compression=None):
+    if compression:
+        return compression
+    for extension in COMPRESSIONS:
+        if image_path.endswith(f".{extension}"):
+            return extension
+    return None
+
+def open_image(image_path, compression=None, input_checksum=False):
+    stream = sys.stdin.buffer if image_path == '-' else open(image_path, 'rb') # pylint: disable=consider-using-with
+    raw_stream = HashingStream(stream) if input_checksum else None
+    source = io.BufferedReader(raw_stream) if raw_stream else stream
+    compression = image_compression(image_path, compression)
+    if compression == 'xz':
+        return lzma.open(source), raw_stream
+    if compression == 'zst':
+        return io.BufferedReader(ZstdStream(source), BUFFER_SIZE), raw_stream
+    return source, raw_stream
+
+def image_data_size(image_path, compression=None, bmap=None):
+    if bmap:
+        return sum(end - start for start, end, _ in bmap_byte_ranges(bmap))
+    if image_path == '-' or image_compression(image_path, compression):
+        return None # unknown before the end of the decompression
+    return os.path.getsize(image_path)
+
+def skip(stream, size):
+    if stream.seekable():
+        stream.seek(size, os.SEEK_CUR)
+        return
+    with memoryview(bytearray(min(BUFFER_SIZE, size))) as trash:
+        while size > 0:
+            read = stream.readinto(trash[:min(len(trash), size)])
+            if not read:
+                raise BlockIOException("Unexpected end of image")
+            size -= read
+
+def fill(stream, view, size):
+    filled = 0
+    while filled < size:
+        read = stream.readinto(view[filled:size])
+        if not read:
+            break
+        filled += read
+    return filled
+
+def open_device(device, flags):
+    # O_DIRECT bypasses the page cache, not supported by every file system
+    try:
+        return os.open(device, flags | os.O_DIRECT, 0o644), True
+    except OSError:
+        return os.open(device, flags, 0o644), False
+
+def disable_direct_io(fd):
+    fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) & ~os.O_DIRECT)
+
+# also used by `sshconf` for the hosts status
+def format_size(size):
+    for unit in ['B', 'KiB', 'MiB', 'GiB']:
+        if size < 1024:
+            break
+        size /= 1024
+    return f"{round(size, 1)} {unit}"
+
+class Progress:
+    def __init__(self, total):
+        self.total = total
+        self.done = 0
+        self.start_time = time.monotonic()
+        self.last_report = self.start_time
+
+    def rate(self):
+        return self.done / max(time.monotonic() - self.start_time, 0.001)
+
+    def text(self):
+        rate = self.rate()
+        text = f"{format_size(self.done)}"
+        if self.total:
+            eta = timedelta(seconds=int((self.total - self.done) / rate)) if rate > 0 else "N/A"
+            text = f"{text} / {format_size(self.total)}, {round(rate / 1000000, 1)} MB/s, ETA {eta}"
+        else:
+            text = f"{text}, {round(rate / 1000000, 1)} MB/s"
+        return text
+
+    def update(self, size):
+        self.done += size
+        now = time.monotonic()
+        if now - self.last_report >= PROGRESS_INTERVAL:
+            self.last_report = now
+            # parsed by towerlib.buildhost to update the task spinner
+            print(f"progress: {self.text()}", file=sys.stderr, flush=True)
+
+class BlockCopy:
+    # a reader thread fills aligned buffers while the main thread writes them
+
+    def __init__(self, device, verify=False):
+        self.device = device
+        self.verify = verify
+        self.buffers = queue.Queue()
+        for _ in range(BUFFER_COUNT):
+            # anonymous mmaps are page aligned, as needed by O_DIRECT
+            self.buffers.put(memoryview(mmap.mmap(-1, BUFFER_SIZE)))
+        self.chunks = queue.Queue(maxsize=BUFFER_COUNT)
+        self.digests = []
+        self.stop = threading.Event()
+
+    def put_chunk(self, offset, stream, size, hasher=None):
+        while size > 0:
+            buffer = self.buffers.get()
+            if self.stop.is_set():
+                return False
+            filled = fill(stream, buffer, min(size, BUFFER_SIZE))
+            if filled == 0:
+                self.buffers.put(buffer)
+                return False
+            if hasher:
+                hasher.update(buffer[:filled])
+            if self.verify:
+                self.digests.append((offset, filled, hashlib.sha256(buffer[:filled]).digest()))
+            self.chunks.put(('data', offset, buffer, filled))
+            offset += filled
+            size -= filled
+        return True
+
+    def read_ranges(self, stream, bmap):
+        try:
+            if bmap:
+                position = 0
+                for start, end, checksum in bmap_byte_ranges(bmap):
+                    skip(stream, start - position)
+                    hasher = hashlib.new(bmap['checksum_type'])
+                    if not self.put_chunk(start, stream, end - start, hasher):
+                        raise BlockIOException("Unexpected end of image")
+                    if hasher.hexdigest() != checksum:
+                        raise BlockIOException(f"Checksum mismatch for bytes {start}-{end}")
+                    position = end
+            else:
+                offset = 0
+                while self.put_chunk(offset, stream, BUFFER_SIZE):
+                    offset += BUFFER_SIZE
+            self.chunks.put(('end',))
+        except Exception as exc: # pylint: disable=broad-exception-caught
+            self.chunks.put(('error', exc))
+
+    def write_chunks(self, fd, direct, progress):
+        written, unsynced = 0, 0
+        while True:
+            chunk = self.chunks.get()
+            if chunk[0] == 'end':
+                return written
+            if chunk[0] == 'error':
+                raise chunk[1]
+            _, offset, buffer, size = chunk
+            if direct and (size % DIRECT_IO_ALIGN or offset % DIRECT_IO_ALIGN):
+                # unaligned tail of the image
+                disable_direct_io(fd)
+                direct = False
+            view = buffer[:size]
+            while len(view) > 0:
+                count = os.pwrite(fd, view, offset)
+                view, offset = view[count:], offset + count
+            self.buffers.put(buffer)
+            written += size
+            unsynced += size
+            if unsynced >= SYNC_INTERVAL:
+                os.fdatasync(fd)
+                unsynced = 0
+            progress.update(size)
+
+    def verify_digests(self):
+        fd, direct = open_device(self.device, os.O_RDONLY)
+        try:
+            if not direct:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            buffer = self.buffers.get()
+            for offset, size, digest in self.digests:
+                # O_DIRECT reads must be aligned: read the whole last block
+                aligned_size = -(-size // DIRECT_IO_ALIGN) * DIRECT_IO_ALIGN if direct else size
+                read = os.preadv(fd, [buffer[:aligned_size]], offset)
+                if read < size or hashlib.sha256(buffer[:size]).digest() != digest:
+                    raise BlockIOException(f"Read-back verification failed at offset {offset}")
+        finally:
+            os.close(fd)
+
+    def copy(self, stream, bmap=None, total=None):
+        progress = Progress(total)
+        fd, direct = open_device(self.device, os.O_WRONLY | os.O_CREAT)
+        reader = threading.Thread(target=self.read_ranges, args=(stream, bmap), daemon=True)
+        reader.start()
+        try:
+            written = self.write_chunks(fd, direct, progress)
+            os.fsync(fd)
+        finally:
+            # unblock the reader if the writer failed
+            self.stop.set()
+            self.buffers.put(memoryview(bytearray(0)))
+            os.close(fd)
+        reader.join()
+        if self.verify:
+            self.verify_digests()
+        return written, progress
+
+# pylint: disable=too-many-arguments
+def write_image(image_path, device, *, bmap_path=None, compression=None, verify=False, input_checksum=False):
+    bmap = read_bmap(bmap_path) if bmap_path else None
+    stream, raw_stream = open_image(image_path, compression, input_checksum)
+    with stream:
+        written, progress = BlockCopy(device, verify).copy(stream, bmap, image_data_size(image_path, compression, bmap))
+    checksum = raw_stream.hexdigest() if raw_stream else None
+    if bmap and os.path.isfile(device) and os.path.getsize(device) < bmap['image_size']:
+        # holes at the end of the image are not written
+        os.truncate(device, bmap['image_size'])
+    image_size = bmap['image_size'] if bmap else written
+    duration = max(time.monotonic() - progress.start_time, 0.001)
+    # same summary line as dd
+    report = f"{written} bytes ({image_size} bytes image) copied, {round(duration, 1)} s, {round(written / duration / 1000000, 1)} MB/s"
+    if checksum:
+        report = f"{report}\nsha256: {checksum}"
+    return report
+
+def zero_device(device):
+    fd = os.open(device, os.O_RDONLY)
+    try:
+        size = os.lseek(fd, 0, os.SEEK_END)
+    finally:
+        os.close(fd)
+    written, progress = BlockCopy(device).copy(ZeroStream(size), total=size)
+    duration = max(time.monotonic() - progress.start_time, 0.001)
+    return f"{written} bytes copied, {round(duration, 1)} s, {round(written / duration / 1000000, 1)} MB/s"
+
+def main():
+    parser = argparse.ArgumentParser(description="Write TowerOS images on block devices.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    bmap_parser = subparsers.add_parser('bmap', help="Generate the block map of a sparse image")
+    bmap_parser.add_argument('image')
+    bmap_parser.add_argument('bmap')
+    write_parser = subparsers.add_parser('write', help="Write an image, `-` for stdin, in a device")
+    write_parser.add_argument('image')
+    write_parser.add_argument('device')
+    write_parser.add_argument('--bmap', help="Only write the blocks mapped in this file and verify their checksum")
+    write_parser.add_argument('--xz', dest='compression', action='store_const', const='xz', help="Image is compressed with xz")
+    write_parser.add_argument('--zstd', dest='compression', action='store_const', const='zst', help="Image is compressed with zstd")
+    write_parser.add_argument('--verify', action='store_true', default=False, help="Read back and check the written blocks")
+    write_parser.add_argument('--sha256', action='store_true', default=False, help="Print the sha256 of the image as read, before decompression")
+    zero_parser = subparsers.add_parser('zero', help="Fill a device with zeros")
+    zero_parser.add_argument('device')
+    args = parser.parse_args()
+    try:
+        if args.command == 'bmap':
+            write_bmap(args.image, args.bmap)
+        elif args.command == 'zero':
+            print(zero_device(args.device))
+        else:
+            print(write_image(args.image, args.device, bmap_path=args.bmap, compression=args.compression, verify=args.verify, input_checksum=args.sha256))
+    except (BlockIOException, OSError) as exc:
+        sys.exit(f"ERROR: {exc}")
+
+if __name__ == '__main__':
+    main()
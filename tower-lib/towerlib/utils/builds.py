@@ -29,20 +29,20 @@ def download_alpine_rpi():
     chek_sha_sum(build_path, config.ALPINE_RPI_CHECKSUM)
     return build_path
 
+def host_image_key(image_path):
+    # toweros-host-<version>-<date>.img[.xz|.zst]: sorted by version then date,
+    # the uncompressed image wins over a compressed one of the same build
+    name = os.path.basename(image_path).split('.img')[0].removeprefix('toweros-host-')
+    version, _, date = name.rpartition('-')
+    version_numbers = tuple(int(number) if number.isdigit() else 0 for number in version.split('.'))
+    return version_numbers, date, image_path.endswith('.img')
+
 def find_host_image():
     if os.path.isdir(config.TOWER_BUILDS_DIR):
-        compressed_host_images = glob.glob(os.path.join(config.TOWER_BUILDS_DIR, 'toweros-host-*.xz'))
-        compressed_host_images.sort()
-        uncompressed_host_images = glob.glob(os.path.join(config.TOWER_BUILDS_DIR, 'toweros-host-*.img'))
-        uncompressed_host_images.sort()
-        if compressed_host_images and uncompressed_host_images:
-            compressed_name = os.path.basename(compressed_host_images[-1]).replace('.img.xz', '')
-            uncompressed_name = os.path.basename(uncompressed_host_images[-1]).replace('.img', '')
-            if compressed_name > uncompressed_name:
-                return compressed_host_images.pop()
-            return uncompressed_host_images.pop()
-        if compressed_host_images:
-            return compressed_host_images.pop()
-        if uncompressed_host_images:
-            return uncompressed_host_images.pop()
+        host_images = []
+        for extension in ['img', 'img.xz', 'img.zst']:
+            host_images += glob.glob(os.path.join(config.TOWER_BUILDS_DIR, f'toweros-host-*.{extension}'))
+        if host_images:
+            host_images.sort(key=host_image_key)
+            return host_images[-1]
     return None
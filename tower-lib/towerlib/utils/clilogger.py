@@ -1,8 +1,5 @@
 import logging
 
-from rich import print as rprint
-from rich.text import Text
-
 def initialize(verbose=False, quiet=False):
     level = logging.INFO
     if verbose != quiet:
@@ -15,4 +12,6 @@ def initialize(verbose=False, quiet=False):
     return logger
 
 def print_error(message):
+    from rich import print as rprint
+    from rich.text import Text
     rprint(Text(f"TOWER ERROR: {message}", style="bold red"))
@@ -1,15 +1,16 @@
 import logging
+import threading
 import time
 from datetime import timedelta
 
-from yaspin import yaspin
-from yaspin.spinners import Spinners
-from rich import print as rich_print
-
 from towerlib.utils.shell import doas
+from towerlib.utils import trace
 
 logger = logging.getLogger('tower')
 
+# spinners of the running tasks, the last one is updated by the progress reporters
+task_state = threading.local()
+
 def exec_task(function, sudo, *args, **kwargs):
     if sudo:
         with doas:
@@ -43,23 +44,65 @@ def format_arg(arg):
         return join_list(arg)
     return f"`{arg}`"
 
+def running_spinners():
+    if not hasattr(task_state, 'spinners'):
+        task_state.spinners = []
+    return task_state.spinners
+
+def progress_reporter():
+    # bound to the running task of the calling thread: usable from other threads, like the `sh` output threads
+    if not running_spinners():
+        return logger.debug
+    spinner, message = running_spinners()[-1]
+    def report(text):
+        spinner.text = f"{message} {text}"
+    return report
+
 def clitask(message=None, timer=True, timer_message="Done in {0}", sudo=False, task_parent=False):
     def decorator(function):
-        def new_function(*args, **kwargs):
-            if timer:
-                start_time = time.time()
-            args_values = list(args) + list(kwargs.values())
-            args_values = [format_arg(arg) for arg in args_values]
-            formated_message = message.format(*args_values)
-            if task_parent:
+        def display_task(formated_message, start_time, *args, **kwargs):
+            ret = None
+            if threading.current_thread() is not threading.main_thread():
+                # concurrent tasks: one line per step, prefixed by the thread name, instead of overlapping spinners
+                thread_name = threading.current_thread().name
+                logger.info("%s: %s", thread_name, formated_message)
+                ret = exec_task(function, sudo, *args, **kwargs)
+                if timer:
+                    logger.info("%s: %s [OK]", thread_name, get_duration_text(start_time, timer_message, formated_message))
+            elif task_parent:
+                from rich import print as rich_print
                 rich_print(f"[bold blue]{formated_message}")
                 ret = exec_task(function, sudo, *args, **kwargs)
                 rich_print(f"[bold green]{get_duration_text(start_time, timer_message)}")
             else:
+                from yaspin import yaspin
+                from yaspin.spinners import Spinners
                 with yaspin(Spinners.bouncingBar, text=formated_message, timer=timer) as spinner:
-                    ret = exec_task(function, sudo, *args, **kwargs)
+                    running_spinners().append((spinner, formated_message))
+                    try:
+                        ret = exec_task(function, sudo, *args, **kwargs)
+                    finally:
+                        running_spinners().pop()
+                    spinner.text = formated_message
                     #spinner.text = get_duration_text(start_time, timer_message, formated_message)
                     spinner.ok("[OK]")
             return ret
+
+        def new_function(*args, **kwargs):
+            start_time = time.time()
+            args_values = list(args) + list(kwargs.values())
+            args_values = [format_arg(arg) for arg in args_values]
+            formated_message = message.format(*args_values)
+            if not trace.is_tracing():
+                return display_task(formated_message, start_time, *args, **kwargs)
+            span = trace.begin_span(formated_message)
+            span_args = trace.displayed_args(message, args_values)
+            try:
+                ret = display_task(formated_message, start_time, *args, **kwargs)
+            except BaseException as exc:
+                trace.end_span(span, function, span_args, task_parent, exc)
+                raise
+            trace.end_span(span, function, span_args, task_parent)
+            return ret
         return new_function
     return decorator
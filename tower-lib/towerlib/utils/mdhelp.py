@@ -1,8 +1,6 @@
 import re
 import argparse
 
-import shtab
-
 def clean_usage(usage):
     cleaned_usage = usage.replace('usage: ', '')
     cleaned_usage = cleaned_usage.replace('\n', ' ')
@@ -119,4 +117,5 @@ def gen_md_help(parser):
     return "\n".join(md_doc)
 
 def insert_autocompletion_command(parser):
+    import shtab
     shtab.add_argument_to(parser, '--print-completion', help=argparse.SUPPRESS)
@@ -4,7 +4,7 @@ import json
 from towerlib.utils.shell import ssh, mkdir, sed, scp, mv, Command
 
 from towerlib.utils.decorators import clitask
-from towerlib.sshconf import get_host_color_name, hosts, get_installed_packages, save_installed_packages, status as get_status
+from towerlib.sshconf import get_host_color_name, hosts, get_installed_packages, save_installed_packages
 from towerlib.config import TOWER_DIR, DESKTOP_FILES_DIR
 
 def restart_sfwbar():
@@ -167,10 +167,21 @@ layout {{
         file_pointer.write(widget)
     restart_sfwbar()
 
-def generate_hosts_status():
-    for host in hosts():
-        host_status = get_status(host, full=True)
-        for key in list(host_status.keys()):
-            host_status[key.replace('-', '')] = host_status.pop(key)
-        with open(os.path.join(TOWER_DIR, f'{host}_status'), 'w', encoding="UTF-8") as file_pointer:
-            json.dump(host_status, file_pointer, indent=4)
+def write_file_atomically(path, content):
+    # readers (sfwbar, `tower status`) never see a half-written file
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding="UTF-8") as file_pointer:
+        file_pointer.write(content)
+    os.replace(tmp_path, path)
+
+def host_status_path(host):
+    return os.path.join(TOWER_DIR, f'{host}_status')
+
+def widget_status(host_status):
+    return json.dumps({key.replace('-', ''): value for key, value in host_status.items()}, indent=4)
+
+def write_host_status(host_status, previous_content=None):
+    content = widget_status(host_status)
+    if content != previous_content:
+        write_file_atomically(host_status_path(host_status['name']), content)
+    return content
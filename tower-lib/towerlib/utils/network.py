@@ -4,9 +4,6 @@ import logging
 import tempfile
 import os
 
-import requests
-from backports.pbkdf2 import pbkdf2_hmac
-
 from towerlib.utils.shell import cp, Command
 from towerlib.utils.decorators import clitask
 from towerlib.utils.shell import mkdir
@@ -14,6 +11,7 @@ from towerlib.utils.shell import mkdir
 logger = logging.getLogger('tower')
 
 def derive_wlan_key(ssid, psk):
+    from backports.pbkdf2 import pbkdf2_hmac
     return binascii.hexlify(pbkdf2_hmac("sha1", psk.encode("utf-8"), ssid.encode("utf-8"), 4096, 32)).decode()
 
 def get_wired_interfaces():
@@ -27,6 +25,7 @@ def get_interfaces():
 
 @clitask("Downloading {0}...")
 def download_file(url, dest_path):
+    import requests
     tmp_dest_path = f"{tempfile.gettempdir()}/" + dest_path.split("/")[-1]
     with requests.get(url, stream=True, timeout=60) as resp:
         resp.raise_for_status()
@@ -1,10 +1,12 @@
+import os
+
 # pylint: disable=import-error,unused-import,no-name-in-module
 from sh import (
-    Command, ErrorReturnCode, ErrorReturnCode_1,
+    Command, ErrorReturnCode, ErrorReturnCode_1, ErrorReturnCode_2, ErrorReturnCode_255, TimeoutException,
     cp, rm, mv, ls, cat, tee, echo, mkdir, chown, truncate, sed, touch,
     lsblk, mount, umount, parted, mkdosfs, dd, losetup,
-    sync, rsync, tar, xz,
-    ssh as sshcli, scp, ssh_keygen, openssl, abuild, abuild_sign, shasum,
+    sync, rsync, tar, xz, zstd,
+    ssh as sshcli, scp as scpcli, ssh_keygen, openssl, abuild, abuild_sign, shasum,
     git as gitcli, pip, apk,
     xsetroot, mcookie, waypipe,
     argparse_manpage,
@@ -13,8 +15,35 @@ from sh import (
 )
 # pylint: enable=import-error,unused-import,no-name-in-module
 
+from towerlib.config import SSH_CONTROL_DIR, SSH_CONTROL_PERSIST
+
+# tunnels must keep their own connection to be killable independently
+SSH_TUNNEL_OPTIONS = ['-L', '-R', '-D', '-W', '-N']
+
+def ssh_control_options():
+    if not os.path.isdir(SSH_CONTROL_DIR):
+        os.makedirs(SSH_CONTROL_DIR, mode=0o700, exist_ok=True)
+    return [
+        '-o', 'ControlMaster=auto',
+        '-o', f"ControlPath={os.path.join(SSH_CONTROL_DIR, '%C')}",
+        '-o', f'ControlPersist={SSH_CONTROL_PERSIST}',
+        '-o', 'ServerAliveInterval=10',
+        '-o', 'ServerAliveCountMax=3',
+    ]
+
+# `sshcli` is a `sh` command: pylint does not know its signature
+# pylint: disable=too-many-function-args,unexpected-keyword-arg
 def ssh(*args, **kwargs):
-    return sshcli(*args, **kwargs)
+    if any(arg in SSH_TUNNEL_OPTIONS for arg in args):
+        return sshcli(*args, **kwargs)
+    return sshcli(*ssh_control_options(), *args, **kwargs)
+
+def ssh_master(host, operation):
+    # `operation` is one of `check` or `exit`, see `ssh -O`
+    return sshcli('-O', operation, *ssh_control_options(), host, _ok_code=[0, 255], _err_to_out=True)
+
+def scp(*args, **kwargs):
+    return scpcli(*ssh_control_options(), *args, **kwargs)
 
 def git(*args, **kwargs):
     return gitcli(*args, **kwargs)
@@ -0,0 +1,199 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from towerlib.utils.decorators import exec_task
+from towerlib.utils.exceptions import BuildException
+
+logger = logging.getLogger('tower')
+
+MAX_WORKERS = 4
+
+
+# declaration of a stage and its run state, read by the runner
+# pylint: disable=too-many-instance-attributes,too-few-public-methods
+class Stage:
+    __slots__ = (
+        'name', 'function', 'inputs', 'outputs',
+        'sources', 'params', 'sudo',
+        'fingerprint', 'skipped', 'start_time', 'end_time',
+    )
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, name, function, inputs=(), outputs=(), *, sources=(), params=(), sudo=False):
+        self.name = name
+        self.function = function
+        # artifacts names: a stage starts when all the stages producing its inputs are done
+        self.inputs = tuple(inputs)
+        self.outputs = tuple(outputs)
+        # files, folders and values the stage depends on, beside its inputs
+        self.sources = tuple(sources)
+        self.params = tuple(params)
+        # only the stages that need root run their commands with `doas`
+        self.sudo = sudo
+        self.fingerprint = None
+        self.skipped = False
+        self.start_time = None
+        self.end_time = None
+
+    def duration(self):
+        return self.end_time - self.start_time
+
+
+def stage_dependencies(stages):
+    producers = {}
+    for stage in stages:
+        for output in stage.outputs:
+            producers[output] = stage.name
+    dependencies = {}
+    for stage in stages:
+        missing = [name for name in stage.inputs if name not in producers]
+        if missing:
+            raise BuildException(f"No stage produces {', '.join(missing)} needed by `{stage.name}`")
+        dependencies[stage.name] = {producers[name] for name in stage.inputs}
+    return dependencies
+
+
+def stage_outputs(stage, result):
+    if len(stage.outputs) == 1:
+        return {stage.outputs[0]: result}
+    return dict(zip(stage.outputs, result or ()))
+
+
+def hash_path(hasher, path):
+    if os.path.isdir(path):
+        for root, dirs, files in os.walk(path):
+            # bytecode changes at each run of the sources
+            dirs[:] = sorted(dir_name for dir_name in dirs if dir_name != '__pycache__')
+            for file_name in sorted(files):
+                hash_path(hasher, os.path.join(root, file_name))
+    elif os.path.exists(path):
+        hasher.update(path.encode())
+        with open(path, 'rb') as file_pointer:
+            while chunk := file_pointer.read(1024 * 1024):
+                hasher.update(chunk)
+
+
+def stage_fingerprint(stage, dependencies, by_name):
+    # changes when a source, a param or the fingerprint of a stage it depends on changes
+    hasher = hashlib.sha256()
+    hasher.update(json.dumps([stage.name, stage.inputs, stage.outputs, [str(param) for param in stage.params]]).encode())
+    for path in stage.sources:
+        hash_path(hasher, path)
+    for name in sorted(dependencies[stage.name]):
+        hasher.update(by_name[name].fingerprint.encode())
+    return hasher.hexdigest()
+
+
+def output_paths(outputs):
+    paths = []
+    for value in outputs.values():
+        for item in value if isinstance(value, (list, tuple)) else [value]:
+            if isinstance(item, str) and os.path.isabs(item):
+                paths.append(item)
+    return paths
+
+
+def manifest_path(checkpoint_dir, stage):
+    return os.path.join(checkpoint_dir, f"{stage.name}.json")
+
+
+def write_manifest(checkpoint_dir, stage, outputs):
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    manifest = {'fingerprint': stage.fingerprint, 'outputs': outputs}
+    with open(f"{manifest_path(checkpoint_dir, stage)}.tmp", 'w', encoding="UTF-8") as file_pointer:
+        json.dump(manifest, file_pointer, indent=4)
+    os.replace(f"{manifest_path(checkpoint_dir, stage)}.tmp", manifest_path(checkpoint_dir, stage))
+
+
+def read_manifest(checkpoint_dir, stage):
+    try:
+        with open(manifest_path(checkpoint_dir, stage), 'r', encoding="UTF-8") as file_pointer:
+            return json.load(file_pointer)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def checkpointed_outputs(checkpoint_dir, stage):
+    # outputs of the previous run if the inputs did not change and the output files are still there
+    manifest = read_manifest(checkpoint_dir, stage)
+    if manifest is None or manifest['fingerprint'] != stage.fingerprint:
+        return None
+    if not all(os.path.exists(path) for path in output_paths(manifest['outputs'])):
+        return None
+    return manifest['outputs']
+
+
+def run_stage(stage, artifacts, checkpoint_dir=None, resume=False):
+    # named after the stage to prefix the tasks output
+    threading.current_thread().name = stage.name
+    stage.start_time = time.monotonic()
+    try:
+        outputs = checkpointed_outputs(checkpoint_dir, stage) if resume else None
+        if outputs is not None:
+            stage.skipped = True
+            logger.info("%s: up to date, skipped", stage.name)
+            return outputs
+        # `doas` is set per thread: enter it again in the worker
+        outputs = stage_outputs(stage, exec_task(stage.function, stage.sudo, *[artifacts[name] for name in stage.inputs]))
+        if checkpoint_dir:
+            write_manifest(checkpoint_dir, stage, outputs)
+        return outputs
+    finally:
+        stage.end_time = time.monotonic()
+
+
+def critical_path(stages, dependencies):
+    # from the last stage to finish, walk back through the dependency that finished last
+    by_name = {stage.name: stage for stage in stages}
+    path = [max(stages, key=lambda stage: stage.end_time)]
+    while dependencies[path[-1].name]:
+        path.append(max((by_name[name] for name in dependencies[path[-1].name]), key=lambda stage: stage.end_time))
+    return list(reversed(path))
+
+
+def report_critical_path(stages, dependencies, start_time):
+    path = critical_path(stages, dependencies)
+    path_text = " -> ".join([
+        f"{stage.name} ({'skipped' if stage.skipped else str(round(stage.duration(), 1)) + 's'})" for stage in path
+    ])
+    logger.info("Critical path: %s", path_text)
+    logger.info(
+        "Stages: %ss in total, %ss wall-clock",
+        round(sum(stage.duration() for stage in stages), 1), round(time.monotonic() - start_time, 1)
+    )
+
+
+def run_stages(stages, artifacts, checkpoint_dir=None, resume=False):
+    # `artifacts` is filled as the stages finish, also usable for cleaning up after a failure
+    # with `checkpoint_dir` the outputs of each stage are recorded, with `resume` they are reused
+    dependencies = stage_dependencies(stages)
+    by_name = {stage.name: stage for stage in stages}
+    start_time = time.monotonic()
+    done, running = set(), {}
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        while len(done) < len(stages):
+            for stage in stages:
+                if stage.name not in done and stage not in running.values() and dependencies[stage.name] <= done:
+                    stage.fingerprint = stage_fingerprint(stage, dependencies, by_name)
+                    running[executor.submit(run_stage, stage, artifacts, checkpoint_dir, resume)] = stage
+            if not running:
+                raise BuildException("Circular dependency between build stages")
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                stage = running.pop(future)
+                if future.exception():
+                    # let the running stages finish before cleaning up
+                    wait(running)
+                    raise future.exception()
+                artifacts.update(future.result())
+                done.add(stage.name)
+    if all(stage.skipped for stage in stages):
+        logger.info("All the stages are up to date")
+    else:
+        report_critical_path(stages, dependencies, start_time)
+    return artifacts
@@ -0,0 +1,60 @@
+import json
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from towerlib.sshconf import iter_status, METRICS_KEYS
+from towerlib.utils import clilogger
+from towerlib.utils.menu import write_host_status, write_file_atomically, host_status_path
+from towerlib.config import STATUS_INTERVAL, STATUS_SNAPSHOT_PATH
+
+logger = logging.getLogger('tower')
+
+STATUS_WORKERS = 16 # hosts probed at the same time
+
+def read_host_status_file(host):
+    try:
+        with open(host_status_path(host), 'r', encoding="UTF-8") as file_pointer:
+            return file_pointer.read()
+    except FileNotFoundError:
+        return None
+
+def with_last_metrics(host_status, last_status):
+    # a host that did not answer in time keeps its last known metrics instead of N/A
+    if host_status['status'] != 'unknown' or last_status is None:
+        return host_status
+    return {**host_status, **{key: last_status[key] for key in METRICS_KEYS if key in last_status}}
+
+def sample_hosts(executor, written, last_hosts_status):
+    hosts_status = {}
+    for host_status in iter_status(full=True, executor=executor):
+        host = host_status['name']
+        host_status = with_last_metrics(host_status, last_hosts_status.get(host))
+        hosts_status[host] = host_status
+        if host not in written:
+            written[host] = read_host_status_file(host)
+        written[host] = write_host_status(host_status, written[host])
+    snapshot = {'time': time.time(), 'hosts': hosts_status}
+    write_file_atomically(STATUS_SNAPSHOT_PATH, json.dumps(snapshot))
+    last_hosts_status.clear()
+    last_hosts_status.update(hosts_status)
+
+def run(interval=STATUS_INTERVAL):
+    # content of each <host>_status file: not rewritten when identical, e.g. for a down host.
+    # The cpu usage of an up host is its average since boot, like `mpstat`: it only moves slowly.
+    written = {}
+    last_hosts_status = {}
+    # one pool for all the samples: the probes are bounded by the status timeout
+    with ThreadPoolExecutor(max_workers=STATUS_WORKERS) as executor:
+        while True:
+            start_time = time.monotonic()
+            try:
+                sample_hosts(executor, written, last_hosts_status)
+            except Exception: # pylint: disable=broad-exception-caught
+                logger.exception("Failed to sample hosts status")
+            # one sample at a time: a slow round delays the next one instead of overlapping it
+            time.sleep(max(0, interval - (time.monotonic() - start_time)))
+
+if __name__ == '__main__':
+    clilogger.initialize()
+    run()
@@ -0,0 +1,86 @@
+import json
+import os
+import string
+import threading
+import time
+
+# Chrome trace / Perfetto json of the clitask spans, see https://ui.perfetto.dev
+
+trace_state = {
+    'path': None,
+    'events': [],
+    'threads': {},
+    'origin': time.perf_counter(),
+}
+trace_lock = threading.Lock()
+span_stack = threading.local()
+
+
+def start_trace(path):
+    trace_state['path'] = path
+    trace_state['origin'] = time.perf_counter()
+
+
+def is_tracing():
+    return trace_state['path'] is not None
+
+
+def now_us():
+    return int((time.perf_counter() - trace_state['origin']) * 1000000)
+
+
+def displayed_args(message, args_values):
+    # only the arguments shown in the task message: the others can be passwords or keys
+    indexes = [field for _, field, _, _ in string.Formatter().parse(message) if field is not None]
+    return [args_values[int(index)] for index in indexes if index.isdigit() and int(index) < len(args_values)]
+
+
+def running_spans():
+    if not hasattr(span_stack, 'names'):
+        span_stack.names = []
+    return span_stack.names
+
+
+def begin_span(name):
+    spans = running_spans()
+    parent = spans[-1] if spans else None
+    spans.append(name)
+    return {'name': name, 'start': now_us(), 'parent': parent, 'depth': len(spans) - 1}
+
+
+def end_span(span, function, args, task_parent, error=None):
+    running_spans().pop()
+    thread = threading.current_thread()
+    event = {
+        'name': span['name'],
+        'cat': 'task_parent' if task_parent else 'task',
+        'ph': 'X',
+        'ts': span['start'],
+        'dur': now_us() - span['start'],
+        'pid': os.getpid(),
+        'tid': thread.native_id,
+        'args': {
+            'function': f"{function.__module__}.{function.__name__}",
+            'args': args,
+            'parent': span['parent'],
+            'depth': span['depth'],
+            'status': 'error' if error else 'ok',
+        },
+    }
+    if error:
+        event['args']['error'] = f"{type(error).__name__}: {error}"
+    with trace_lock:
+        trace_state['events'].append(event)
+        # worker threads are renamed after their host or stage
+        trace_state['threads'][thread.native_id] = thread.name
+
+
+def write_trace():
+    if not is_tracing():
+        return
+    with trace_lock:
+        events = list(trace_state['events'])
+        for tid, thread_name in trace_state['threads'].items():
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': tid, 'args': {'name': thread_name}})
+    with open(trace_state['path'], 'w', encoding="UTF-8") as file_pointer:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, file_pointer)